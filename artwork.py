@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from cache import SingleFlight
+from sessions import SharedSession
+
+import aiohttp
+import asyncio
+import json
+import metrics
+import os
+import utils
+
+#################################################
+
+def parse_artwork(content):
+    """
+    Gets the song artwork from the HTML of a song's chart page.
+    :param content: HTML of the chart page
+    :return: Link to artwork in proper format
+    :raises ValueError: If the page can't be parsed, e.g. it came back empty
+    """
+
+    import lxml.etree
+    import lxml.html
+
+    try:
+        page = lxml.html.fromstring(content)
+
+    except lxml.etree.LxmlError as e:
+        raise ValueError(f"Unreadable chart page: {e}")
+    images = [img.get('src', '') for img in page.iter('img')]
+
+    # very hacky code based on the way the site's images are formatted.
+    # not sure how to improve
+    artwork = "".join(src for src in images if 'thumbnail' in src)
+
+    if (root := "../..") in artwork:
+        artwork = artwork.replace(root, utils.PREFIX)
+    else:
+        artwork = utils.PREFIX + artwork
+
+    return artwork
+
+#################################################
+
+class ArtworkCache:
+    """
+    Song key -> artwork link, evicting the least recently used entry once
+    full. Persisted as JSON so artwork survives restarts.
+    """
+    def __init__(self, path = utils.ARTWORK_PATH, max_size = utils.ARTWORK_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.unsaved = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def put(self, key, artwork):
+        self.entries[key] = artwork
+        self.entries.move_to_end(key)
+        self.unsaved += 1
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def load(self):
+        try:
+            with open(self.path, encoding = 'utf-8') as f:
+                entries = json.load(f)
+
+        except (OSError, ValueError):
+            return
+
+        for key, artwork in entries.items():
+            self.put(key, artwork)
+
+        self.unsaved = 0
+
+    def save(self, entries = None):
+        """
+        :param entries: Copy of self.entries to write instead, see 
+                        cache.save_periodically
+        """
+
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(self.entries if entries is None else entries, f, ensure_ascii = False)
+
+        os.replace(tmp_path, self.path)
+
+#################################################
+
+class ArtworkResolver:
+    """
+    Resolves artwork through a shared aiohttp connection pool, so fetching
+    a chart page never blocks the event loop. Concurrent fetches of the same
+    page share a single request.
+    """
+    def __init__(self, cache, session = None):
+        self.cache = cache
+        self.session = session or SharedSession()
+        self.flights = SingleFlight()
+
+    async def fetch(self, link):
+        """
+        Downloads a chart page and parses the artwork out of it, or waits
+        for a download of the same page already in flight.
+        :param link: Link to the chart page
+        :return: Link to artwork
+        :raises ValueError: If the page can't be parsed
+        """
+
+        return await self.flights.run(link, lambda: self.download(link))
+
+    async def download(self, link):
+        with metrics.span('artwork'):
+            async with self.session.get().get(link) as r:
+                r.raise_for_status()
+                content = await r.read()
+
+            return parse_artwork(content)
+
+    async def resolve(self, key, link):
+        """
+        Returns the artwork of a song, only fetching its chart page if
+        it isn't cached yet.
+        :param key: Song key
+        :param link: Link to the song's CHAOS chart page
+        :return: Link to artwork, or None if it could not be fetched
+        """
+
+        if (artwork := self.cache.get(key)) is not None:
+            return artwork
+
+        # a page that can't be parsed is treated like one that can't be
+        # fetched, the song is simply shown without its artwork
+        try:
+            artwork = await self.fetch(link)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+
+        self.cache.put(key, artwork)
+
+        return artwork
+
+    async def prefetch(self, links, concurrency = utils.PREFETCH_CONCURRENCY):
+        """
+        Resolves the artwork of every song not cached yet, a few at a time.
+        Saving the cache is left to the caller.
+        :param links: Dictionary in the format {<key> : <CHAOS link>}
+        :param concurrency: Maximum number of pages fetched at once
+        """
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def prefetch_one(key, link):
+            async with semaphore:
+                try:
+                    self.cache.put(key, await self.fetch(link))
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    pass
+
+        await asyncio.gather(*(prefetch_one(key, link)
+                    for key, link in links.items() if key not in self.cache))
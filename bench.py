@@ -0,0 +1,280 @@
+import argparse
+import glob
+import json
+import random
+import re
+import statistics
+import time
+import tracemalloc
+
+import c2v
+import search
+import utils
+
+#################################################
+
+# words synthetic titles are made from, Japanese ones mix kana and kanji
+# so romanization has real work to do
+WORDS = ["chrome", "vox", "halcyon", "stranger", "landing", "sky", "night", "dream",
+            "light", "garden", "heart", "star", "fire", "ocean", "zero", "eclipse"]
+KANA = ["さくら", "ゆめ", "ほし", "カーテン", "サテライト", "ミライ", "こころ", "ソラ"]
+KANJI = ["風", "幻想", "夜", "月", "花", "光", "雨", "空"]
+CHARACTERS = ["PAFF", "NEKO", "ROBO_Head", "Xenon", "ConneR", "Cherry", "JOE", "Aroma"]
+
+QUERIES_PER_KIND = 50
+
+#################################################
+
+def make_title(rng, i):
+    if rng.random() < 0.3:
+        return f"{rng.choice(KANJI)}の{rng.choice(KANA)}{i}"
+
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 3))) + f" {i}"
+
+def make_chartlist(size, seed = 0):
+    """
+    Builds a chartlist page laid out like the site's, with synthetic songs.
+    :param size: Number of songs
+    :param seed: Seed for the random titles and levels
+    :return: HTML of the page
+    """
+
+    rng = random.Random(seed)
+    headers = "".join(f"<th>{header}</th>" for header in
+                ["Song", "Artist", "Character", "BPM"] + ["Lv.", "Chart Page"] * 4 + ["Chart Page"])
+    rows = []
+
+    for i in range(size):
+        key = f"song_{i}"
+        cells = [make_title(rng, i), f"Artist {rng.randint(0, size // 4)}",
+                    rng.choice(CHARACTERS), str(rng.randint(80, 250))]
+        cells = [f"<td>{cell}</td>" for cell in cells]
+
+        for diff, low, high in [("easy", 1, 6), ("hard", 5, 11), ("chaos", 10, 15), ("glitch", 12, 16)]:
+            if diff == "glitch" and rng.random() < 0.7:
+                cells.append("<td></td><td></td>")
+                continue
+
+            cells.append(f"<td>{rng.randint(low, high)}</td>"
+                f'<td><a href="{utils.PREFIX}/chartlist/{key}/{diff}">View</a></td>')
+
+        rows.append(f"<tr>{''.join(cells)}<td></td></tr>")
+
+    return (f"<html><body><table><thead><tr>{headers}</tr></thead>"
+            f"<tbody>{''.join(rows)}</tbody></table></body></html>")
+
+def scale_chartlist(content, size):
+    """
+    Repeats the songs of a saved chartlist page until it has size songs,
+    giving every copy its own title and key.
+    :param content: HTML of a saved chartlist page
+    :param size: Number of songs wanted
+    :return: HTML of the page
+    """
+
+    charts_df, merged_dict = c2v.parse_chartlist(content)
+    original = len(charts_df)
+
+    if original >= size:
+        return content
+
+    page = content.decode("UTF-8") if isinstance(content, bytes) else content
+    head, _, rest = page.partition("<tbody>")
+    body, _, tail = rest.partition("</tbody>")
+
+    copies = [body]
+
+    for copy in range(1, -(-size // original)):
+        # suffix the first cell of every row, i.e. the title
+        copied = re.sub(r"(<tr[^>]*>\s*<td[^>]*>)(.*?)(</td>)", 
+                            rf"\g<1>\g<2> {copy}\g<3>", body, flags = re.S)
+        copies.append(copied.replace("/chartlist/", f"/chartlist/copy{copy}_"))
+
+    return f"{head}<tbody>{''.join(copies)}</tbody>{tail}"
+
+def make_queries(songs, seed = 0):
+    """
+    A realistic mix of queries: English titles, romaji, kana and typos.
+    :param songs: Songs of the catalog to draw the queries from
+    :return: List of queries
+    """
+
+    rng = random.Random(seed)
+    romaji = [song.key_j for song in songs if song.key_j] or [song.song for song in songs]
+    kana = [song.hiragana for song in songs if song.hiragana] or [song.song for song in songs]
+    songs = [song.song for song in songs]
+
+    def typo(text):
+        chars = list(text)
+        for _ in range(rng.randint(1, 2)):
+            chars[rng.randrange(len(chars))] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+        return "".join(chars)
+
+    queries = []
+
+    for _ in range(QUERIES_PER_KIND):
+        queries.append(rng.choice(songs))
+        queries.append(rng.choice(romaji))
+        queries.append(rng.choice(kana))
+        queries.append(typo(rng.choice(songs)))
+
+    return queries
+
+#################################################
+
+def measure(function, inputs, repeat = 1):
+    """
+    Times a function over every input.
+    :param function: Function taking a single input
+    :param inputs: List of inputs
+    :param repeat: Times to go over the inputs
+    :return: Dictionary of p50/p99 latency (ms), throughput (calls/s) and
+             peak memory allocated during the calls (MB)
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        for value in inputs:
+            start = time.perf_counter()
+            function(value)
+            timings.append(time.perf_counter() - start)
+
+    # tracing slows everything down, so memory gets its own pass
+    tracemalloc.start()
+
+    for value in inputs:
+        function(value)
+
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+
+    return {
+        'p50_ms': statistics.median(timings) * 1000,
+        'p99_ms': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        'per_s': len(timings) / sum(timings) if sum(timings) else float('inf'),
+        'peak_mb': peak / 1024 / 1024,
+    }
+
+def bench_catalog(content, results, label):
+    """
+    Benchmarks ingestion, preprocessing and searching on one page.
+    """
+
+    results[f"{label}/parse_chartlist"] = measure(c2v.parse_chartlist, [content], repeat = 3)
+
+    charts_df, merged_dict = c2v.parse_chartlist(content)
+
+    results[f"{label}/get_songs cold"] = measure(
+            lambda df: c2v.get_songs(df, merged_dict, (), {}), [charts_df])
+
+    romanizations = {}
+    songs, _ = c2v.get_songs(charts_df, merged_dict, (), romanizations)
+
+    results[f"{label}/get_songs warm"] = measure(
+            lambda df: c2v.get_songs(df, merged_dict, (), romanizations), [charts_df])
+
+    # an update adding the last 1% of the songs to an otherwise unchanged catalog
+    previous, _ = c2v.get_songs(charts_df.iloc[: len(charts_df) * 99 // 100], 
+                                    merged_dict, (), romanizations)
+
+    results[f"{label}/get_songs update"] = measure(
+            lambda previous: c2v.get_songs(charts_df, merged_dict, previous, romanizations), [previous])
+
+    results[f"{label}/SearchIndex build"] = measure(search.SearchIndex, [songs])
+    results[f"{label}/LevelIndex build"] = measure(search.LevelIndex, [songs])
+    results[f"{label}/PrefixIndex build"] = measure(search.PrefixIndex, [songs])
+
+    previous_index = search.SearchIndex(previous)
+    previous_prefixes = search.PrefixIndex(previous)
+    removed, added = set(previous) - set(songs), set(songs) - set(previous)
+
+    results[f"{label}/SearchIndex update"] = measure(
+            lambda index: search.SearchIndex(songs, previous = index), [previous_index])
+    results[f"{label}/PrefixIndex update"] = measure(
+            lambda index: index.updated(removed, added), [previous_prefixes])
+
+    index = search.SearchIndex(songs)
+    levels = search.LevelIndex(songs)
+
+    results[f"{label}/search"] = measure(index.search, make_queries(songs))
+    results[f"{label}/complete"] = measure(search.PrefixIndex(songs).complete,
+            [query[:length] for query in make_queries(songs) for length in (1, 3, 6)])
+    results[f"{label}/search_difficulty"] = measure(
+            lambda query: levels.search(*query),
+            [(level, level) for level in range(1, 16)] + [(13, 15, ['chaos'], 'bpm')], repeat = 5)
+
+def bench_ocr(images, results):
+    """
+    Benchmarks the OCR pipeline on sample screenshots. The tesseract passes
+    are skipped if tesseract isn't installed.
+    """
+
+    import ocr
+
+    data = []
+    for path in images:
+        with open(path, 'rb') as f:
+            data.append(f.read())
+
+    results["ocr/decode + preprocess + crop"] = measure(
+            lambda image: ocr.crop_regions(ocr.preprocess(ocr.decode_image(image))), data, repeat = 3)
+    results["ocr/perceptual_hash"] = measure(ocr.perceptual_hash, data, repeat = 3)
+
+    try:
+        ocr.init_worker()
+    except Exception:
+        print("tesseract not found, skipping OCR passes")
+        return
+
+    results["ocr/process_image"] = measure(ocr.process_image, data)
+
+#################################################
+
+def report(results, baseline = None):
+    print(f"{'benchmark':<40}{'p50 ms':>10}{'p99 ms':>10}{'per s':>12}{'peak MB':>10}{'vs base':>10}")
+
+    for name, result in results.items():
+        change = ""
+
+        if baseline and name in baseline and baseline[name]['p50_ms']:
+            change = f"{result['p50_ms'] / baseline[name]['p50_ms']:.2f}x"
+
+        print(f"{name:<40}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+                f"{result['per_s']:>12.1f}{result['peak_mb']:>10.2f}{change:>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Offline benchmarks of the bot's hot paths.")
+    parser.add_argument("--page", help = "saved chartlist.html to scale up, synthetic songs otherwise")
+    parser.add_argument("--sizes", default = "300,3000,30000", help = "comma separated catalog sizes")
+    parser.add_argument("--images", help = "glob of sample screenshots for the OCR benchmarks")
+    parser.add_argument("--baseline", default = "bench_baseline.json", help = "results to compare against")
+    parser.add_argument("--save", action = "store_true", help = "store these results as the baseline")
+    args = parser.parse_args()
+
+    results = {}
+
+    if args.page:
+        with open(args.page, 'rb') as f:
+            page = f.read()
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        content = scale_chartlist(page, size) if args.page else make_chartlist(size)
+        bench_catalog(content, results, str(size))
+
+    if args.images:
+        bench_ocr(sorted(glob.glob(args.images)), results)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = None
+
+    report(results, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 2)
@@ -1,13 +1,40 @@
+import metrics
+import utils
+
+# with PROFILE_STARTUP=1 each dependency is imported (and timed) here one at
+# a time, the imports below then find them already loaded
+startup = metrics.StartupProfile()
+startup.imports(["discord", "aiohttp", "numpy", "fuzzywuzzy", "search", "c2v",
+                    "catalog", "artwork", "cache", "crawler", "executor", "ocr", "outbound", "sessions"])
+
 import discord
 from discord.ext import commands
+import aiohttp
+import asyncio
 import re
+import time
 
+import artwork
 import c2v
+import cache
+import crawler
+import executor
+import ocr
+import outbound
+import catalog
+import search
 import secret
-import utils
+import sessions
 
 TOKEN = secret.TOKEN
-client = commands.Bot(command_prefix = "!")
+
+class Bot(commands.Bot):
+    async def close(self):
+        # the shared session belongs to the loop, which is gone once run returns
+        await http_session.close()
+        await super().close()
+
+client = Bot(command_prefix = "!")
 
 @client.event
 async def on_ready():
@@ -16,6 +43,28 @@ async def on_ready():
     print(client.user.id)
     print("------")
 
+    startup.report(label = "ready")
+
+    global refreshing
+
+    # on_ready also fires on reconnects, only start refreshing once
+    if not refreshing:
+        refreshing = True
+        client.loop.create_task(refresh_catalog())
+
+        client.loop.create_task(cache.save_periodically([artwork_cache, ocr_cache]))
+
+        if utils.METRICS_ENABLED:
+            client.loop.create_task(write_metrics())
+
+@client.before_invoke
+async def start_timer(ctx):
+    ctx.start_time = time.perf_counter()
+
+@client.after_invoke
+async def stop_timer(ctx):
+    metrics.observe(f"command_{ctx.command.name}", time.perf_counter() - ctx.start_time)
+
 #################################################
 
 @client.command()
@@ -26,13 +75,13 @@ async def c2tier(message, *, arg):
     channel = message.channel
 
     if arg == '12':
-        await channel.send('https://i.imgur.com/jQiHNk2.jpg')
+        await send_queue.send(channel, 'https://i.imgur.com/jQiHNk2.jpg')
     elif arg == '13':
-        await channel.send('https://i.imgur.com/HYcgkDo.jpg')
+        await send_queue.send(channel, 'https://i.imgur.com/HYcgkDo.jpg')
     elif arg == '14':
-        await channel.send('https://i.imgur.com/hdf3FZD.jpg')
+        await send_queue.send(channel, 'https://i.imgur.com/hdf3FZD.jpg')
     elif arg == '15':
-        await channel.send('https://i.imgur.com/wpsrc18.jpg')
+        await send_queue.send(channel, 'https://i.imgur.com/wpsrc18.jpg')
 
 @c2tier.error 
 async def c2tier_error(ctx, error):
@@ -40,7 +89,7 @@ async def c2tier_error(ctx, error):
     Error handler in case user forgets to specify the difficulty level.
     """
     if isinstance(error, commands.MissingRequiredArgument):    
-        await ctx.send(embed = utils.generate_embed(
+        await send_queue.send(ctx.channel, embed = utils.generate_embed(
                 status = 'Error',
                 msg = "Please also specify which level you require: 12, 13, 14 or 15."
             ))
@@ -49,13 +98,115 @@ async def c2tier_error(ctx, error):
 #################################################
 
 # initializing dataframe used for searching songs and dictionary for storing links
-table = c2v.get_table(utils.SOURCE)
-charts_df = c2v.get_initial_df(utils.SOURCE)
+# from the local snapshot, the site is only scraped if there is none yet.
+# commands read refresher.catalog once and use that for the whole command
+send_queue = outbound.SendQueue()
+page_cache = outbound.PageCache()
+http_session = sessions.SharedSession()
+
+with startup.step("load catalog"):
+    refresher = catalog.CatalogRefresher(catalog.load_catalog())
+
+with startup.step("load artwork cache"):
+    artwork_cache = artwork.ArtworkCache()
+    artwork_cache.load()
+    artwork_resolver = artwork.ArtworkResolver(artwork_cache, http_session)
+
+with startup.step("load chart store"):
+    chart_store = crawler.ChartStore()
+    chart_store.load()
+    chart_crawler = crawler.ChartCrawler(chart_store)
+
+with startup.step("start search executor"):
+    search_cache = cache.QueryCache()
+    search_executor = executor.SearchExecutor()
+
+with startup.step("load ocr cache"):
+    ocr_cache = cache.OCRCache(path = utils.OCR_CACHE_PATH)
+    ocr_cache.load()
+    ocr_engine = ocr.OCREngine(cache = ocr_cache)
+    screenshot_intake = ocr.ScreenshotIntake(session = http_session)
+
+metrics.register_gauge("query_cache_size", lambda: len(search_cache))
+metrics.register_gauge("query_cache_hits", lambda: search_cache.hits)
+metrics.register_gauge("query_cache_misses", lambda: search_cache.misses)
+metrics.register_gauge("artwork_cache_size", lambda: len(artwork_cache))
+metrics.register_gauge("chart_store_size", lambda: len(chart_store))
+metrics.register_gauge("ocr_cache_size", lambda: len(ocr_cache))
+metrics.register_gauge("ocr_cache_hits", lambda: ocr_cache.hits)
+metrics.register_gauge("ocr_cache_misses", lambda: ocr_cache.misses)
+metrics.register_gauge("search_queue", lambda: search_executor.pending)
+metrics.register_gauge("ocr_queue", lambda: ocr_engine.pending)
+metrics.register_gauge("ocr_abandoned", lambda: ocr_engine.abandoned)
+metrics.register_gauge("send_queue", lambda: send_queue.waiting)
+metrics.register_gauge("paged_messages", lambda: len(page_cache))
+metrics.register_gauge("searches_shared", lambda: search_executor.flights.shared)
+metrics.register_gauge("artwork_fetches_shared", lambda: artwork_resolver.flights.shared)
+metrics.register_gauge("catalog_songs", lambda: len(refresher.catalog))
+metrics.register_gauge("catalog_refresh_failures", lambda: refresher.failures)
+
+async def write_metrics():
+    """
+    Periodically writes the metrics out for Prometheus.
+    """
+    while True:
+        await asyncio.sleep(utils.METRICS_INTERVAL)
+        metrics.write_prometheus()
+
+refreshing = False
+crawl_task = None
+
+async def crawl_charts(data):
+    """
+    Crawls the details of every chart of a catalog not stored yet. The
+    crawler also fills in missing artwork from the CHAOS pages, so searches
+    don't have to fetch it.
+    """
+    try:
+        stats = await chart_crawler.crawl(data.merged_dict, artwork_cache)
 
-merged_dict = c2v.merge_keys_and_links(table)
+    except Exception as e:
+        print(f"Chart crawl stopped: {e}")
+        return
+
+    print(f"Chart crawl done: {stats['fetched']} fetched, {stats['failed']} failed.")
+
+def start_crawl(data):
+    """
+    Crawls a catalog in its own task, so a long crawl never holds up the
+    catalog refreshes. A crawl of an older catalog still running is 
+    cancelled, after saving what it fetched so far.
+    """
+    global crawl_task
 
-merged_df = c2v.get_merged_df(charts_df, merged_dict)
-merged_df.to_csv("test.csv")
+    if crawl_task is not None:
+        crawl_task.cancel()
+
+    crawl_task = client.loop.create_task(crawl_charts(data))
+
+async def update_catalog(data):
+    """
+    Called with every new catalog. Details and artwork of songs whose 
+    charts changed since the last catalog are fetched again.
+    """
+    for key, fields in data.changes['changed'].items():
+        if 'links' in fields or 'levels' in fields:
+            chart_store.discard(key)
+
+        if 'links' in fields:
+            artwork_cache.discard(key)
+
+    for key in data.changes['removed']:
+        chart_store.discard(key)
+
+    start_crawl(data)
+
+async def refresh_catalog():
+    """
+    Keeps the catalog up to date in the background once the bot is up.
+    """
+    start_crawl(refresher.catalog)
+    await refresher.run(on_update = update_catalog)
 
 #################################################
 
@@ -71,19 +222,49 @@ async def c2s(message, *, arg):
     is_ping = re.search(utils.PING_REGEX, arg)    
 
     if is_emote or is_ping:
-        await channel.send(embed = utils.generate_embed(
+        await send_queue.send(channel, embed = utils.generate_embed(
                 status = 'Error',
                 msg = 'Invalid input. Ping, emote, or channel name detected.'
             ))
         return
 
-    result = c2v.search_song(merged_df, arg)
-    embed = c2v.process_search(merged_dict, result)
+    # keep hold of the catalog searched, in case it is swapped while awaiting
+    data = refresher.catalog
+    query = utils.normalize_query(arg)
 
-    print(embed)
-    print(type(embed))
+    if (cached := search_cache.get(data.version, query)) is not None:
+        matches, payload = cached
+        await send_queue.send(channel, embed = discord.Embed.from_dict(payload))
+        return
+
+    try:
+        with metrics.span('search'):
+            matches = await search_executor.search(data, query)
+
+    except executor.Busy:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'Too many searches at the moment. Please try again shortly.'
+            ))
+        return
+
+    best_matches = search.get_best_matches(matches)
+    artwork_url = None
+
+    # usually already cached by the chart crawl, otherwise fetched without blocking
+    if len(best_matches) == 1:
+        song = data.songs[best_matches[0].row]
+        artwork_url = await artwork_resolver.resolve(song.key, song.links[2])
+
+    with metrics.span('embed'):
+        embed = c2v.process_search(data.songs, matches, artwork_cache)
+
+    # an embed still missing its artwork is left out so it gets retried
+    if len(best_matches) != 1 or artwork_url is not None:
+        search_cache.put(data.version, query, (matches, embed.to_dict()))
 
-    await channel.send(embed = embed)
+    with metrics.span('send'):
+        await send_queue.send(channel, embed = embed)
 
 @c2s.error 
 async def c2s_error(ctx, error):
@@ -91,49 +272,267 @@ async def c2s_error(ctx, error):
     Error handler in case user forgets to specify the difficulty level.
     """
     if isinstance(error, commands.MissingRequiredArgument):    
-        await ctx.send(embed = utils.generate_embed(
+        await send_queue.send(ctx.channel, embed = utils.generate_embed(
                 status = 'Error',
                 msg = "Please also specify a search key."
             ))
 
 #################################################
 
+@client.command()
+async def c2m(message, *, arg):
+    """
+    Searches for several songs at once and answers with a single table, 
+    e.g. !c2m chrome vox; halcyon; conflict. Songs can also go one per line.
+    """
+    channel = message.channel
+
+    is_emote = re.search(utils.EMOTE_REGEX, arg)
+    is_ping = re.search(utils.PING_REGEX, arg)    
+
+    if is_emote or is_ping:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'Invalid input. Ping, emote, or channel name detected.'
+            ))
+        return
+
+    try:
+        queries = c2v.parse_queries(arg)
+
+    except ValueError as e:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = f'Invalid input. {e}'
+            ))
+        return
+
+    data = refresher.catalog
+    results = {}
+
+    # queries !c2s already answered are taken from its cache, the rest are
+    # searched as one batch
+    for query in queries:
+        if (cached := search_cache.get(data.version, query)) is not None:
+            results[query] = cached[0]
+
+    remaining = [query for query in dict.fromkeys(queries) if query not in results]
+
+    try:
+        with metrics.span('search_many'):
+            if remaining:
+                results.update(zip(remaining, await search_executor.search_many(data, remaining)))
+
+    except executor.Busy:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'Too many searches at the moment. Please try again shortly.'
+            ))
+        return
+
+    with metrics.span('embed'):
+        embed = c2v.embed_many(data.songs, queries, [results[query] for query in queries])
+
+    with metrics.span('send'):
+        await send_queue.send(channel, embed = embed)
+
+@c2m.error 
+async def c2m_error(ctx, error):
+    if isinstance(error, commands.MissingRequiredArgument):    
+        await send_queue.send(ctx.channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = "Please also specify the songs to search for."
+            ))
+
+#################################################
+
 @client.command()
 async def c2d(message, *, arg):
+    """
+    Lists the songs with charts of a level or range of levels, e.g. 
+    !c2d 14 or !c2d 13-15 chaos bpm.
+    """
     channel = message.channel
 
     is_emote = re.search(utils.EMOTE_REGEX, arg)
     is_ping = re.search(utils.PING_REGEX, arg) 
 
     if is_emote or is_ping:
-        await channel.send(embed = utils.generate_embed(
+        await send_queue.send(channel, embed = utils.generate_embed(
                 status = 'Error',
                 msg = 'Invalid input. Ping, emote, or channel name detected.'
             ))
         return
 
     try:
-        input = int(arg)
-        if input in range(1, 16):
-            output = c2v.search_difficulty(merged_df, input)
+        low, high, difficulties, sort = c2v.parse_difficulty_query(arg)
+
+    except ValueError as e:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = f'Invalid input. {e}'
+            ))
+        return
+
+    data = refresher.catalog
+
+    try:
+        with metrics.span('search_difficulty'):
+            rows = await search_executor.search_levels(data, low, high, difficulties, sort)
+
+    except executor.Busy:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'Too many searches at the moment. Please try again shortly.'
+            ))
+        return
+
+    if not rows:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'No songs found.'
+            ))
+        return
+
+    pages = c2v.embed_pages(c2v.get_pages([data.levels.songs[row] for row in rows]),
+                                title = f"Level {low}" if low == high else f"Levels {low}-{high}")
+
+    with metrics.span('send'):
+        sent = await send_queue.send(channel, embed = pages[0])
+
+    # the rest are only sent if asked for, by reacting to the first page
+    if len(pages) > 1:
+        page_cache.put(sent.id, pages)
+
+        for emoji in utils.PAGE_REACTIONS:
+            await send_queue.add_reaction(sent, emoji)
+
+@client.event
+async def on_reaction_add(reaction, user):
+    """
+    Turns the page of a paged message, e.g. the output of !c2d.
+    """
+    if user == client.user or (step := utils.PAGE_REACTIONS.get(str(reaction.emoji))) is None:
+        return
+
+    if (page := page_cache.turn(reaction.message.id, step)) is None:
+        return
+
+    await send_queue.edit(reaction.message, embed = page)
+
+    # lets the same arrow be used again, needs the Manage Messages permission
+    try:
+        await send_queue.remove_reaction(reaction, user)
+    except discord.HTTPException:
+        pass
 
-            for page in output:
-                await channel.send(", ".join(page))
+#################################################
 
-        else:
-            await channel.send(embed = utils.generate_embed(
+@client.command()
+async def c2ocr(message):
+    """
+    Reads the results of plays from screenshots attached to the message.
+    """
+    channel = message.channel
+    attachments = [attachment for attachment in message.message.attachments
+                    if (attachment.content_type or "").startswith("image/")]
+
+    if not attachments:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'Please attach a screenshot of your result.'
+            ))
+        return
+
+    for attachment in attachments:
+        if attachment.size > utils.SCREENSHOT_MAX_BYTES:
+            await send_queue.send(channel, embed = utils.generate_embed(
                     status = 'Error',
-                    msg = 'Invalid input. Not within correct difficulty range.'
+                    msg = f'{attachment.filename} is too large.'
+                ))
+            continue
+
+        try:
+            data = await screenshot_intake.read(attachment.url)
+            result = await ocr_engine.process(data, refresher.catalog)
+
+        except executor.Busy:
+            await send_queue.send(channel, embed = utils.generate_embed(
+                    status = 'Error',
+                    msg = 'Too many screenshots at the moment. Please try again shortly.'
                 ))
             return
 
-    except:
-        await channel.send(embed = utils.generate_embed(
+        except ocr.Unavailable as e:
+            await send_queue.send(channel, embed = utils.generate_embed(
+                    status = 'Error',
+                    msg = f'{e} Please let the bot owner know.'
+                ))
+            return
+
+        except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await send_queue.send(channel, embed = utils.generate_embed(
+                    status = 'Error',
+                    msg = f'Unable to read {attachment.filename}. {e}'
+                ))
+            continue
+
+        await send_queue.send(channel, embed = c2v.embed_score(result))
+
+#################################################
+
+@client.command()
+async def c2complete(message, *, arg):
+    """
+    Lists songs whose title, romanized title, artist or key starts with
+    what was typed, e.g. !c2complete chr.
+    """
+    channel = message.channel
+    data = refresher.catalog
+
+    titles = data.prefixes.complete(arg)
+
+    if not titles:
+        await send_queue.send(channel, embed = utils.generate_embed(
+                status = 'Error',
+                msg = 'No songs start with that.'
+            ))
+        return
+
+    await send_queue.send(channel, "\r\n".join(titles))
+
+@c2complete.error 
+async def c2complete_error(ctx, error):
+    if isinstance(error, commands.MissingRequiredArgument):    
+        await send_queue.send(ctx.channel, embed = utils.generate_embed(
                 status = 'Error',
-                msg = 'Invalid input. Not a number.'
+                msg = "Please also specify the start of a song's name."
             ))
+
+#################################################
+
+@client.command()
+@commands.is_owner()
+async def c2stats(message):
+    """
+    Owner only. Shows how long each stage of the bot has been taking, along
+    with cache and queue sizes.
+    """
+    if not utils.METRICS_ENABLED:
+        await send_queue.send(message.channel, "Metrics are disabled.")
         return
 
+    await send_queue.send(message.channel, f"```\n{metrics.format_stats()}\n```")
+
 #################################################
 
-client.run(TOKEN)
\ No newline at end of file
+startup.report()
+
+client.run(TOKEN)
+
+# whatever the periodic save didn't get to before the bot stopped
+artwork_cache.save()
+ocr_cache.save()
+
+search_executor.shutdown()
+ocr_engine.shutdown()
\ No newline at end of file
@@ -1,381 +1,675 @@
-from bs4 import BeautifulSoup 
-from fuzzywuzzy import fuzz
-from pykakasi import kakasi
 from collections import Counter, defaultdict
+from operator import attrgetter
 
-import requests
-import pandas as pd
+import json
+import os
 import re
-import numpy as np
 import discord
+import search
 import utils
 
+# pandas, lxml and pykakasi are only needed to build a catalog from the
+# site, so they are imported on first use rather than whenever the bot
+# starts from a snapshot
+
 #################################################
 
-# initialized settings for pykakasi module
-kakasi = kakasi()
-kakasi.setMode("H","a") # Hiragana to ascii, default: no conversion
-kakasi.setMode("K","a") # Katakana to ascii, default: no conversion
-kakasi.setMode("J","a") # Japanese to ascii, default: no conversion
-kakasi.setMode("r","Hepburn") # default: use Hepburn Roman table
-kakasi.setMode("s", True) # add space, default: no separator
-kakasi.setMode("C", False) # capitalize, default: no capitalize
-conv = kakasi.getConverter()
+# pykakasi loads its dictionaries when created, so it is only set up the
+# first time a title has to be romanized
+converters = None
+
+def get_converters():
+    """
+    :return: Tuple of the pykakasi instance and its Hepburn converter
+    """
+    global converters
+
+    if converters is None:
+        from pykakasi import kakasi
+
+        # initialized settings for pykakasi module
+        kakasi = kakasi()
+        kakasi.setMode("H","a") # Hiragana to ascii, default: no conversion
+        kakasi.setMode("K","a") # Katakana to ascii, default: no conversion
+        kakasi.setMode("J","a") # Japanese to ascii, default: no conversion
+        kakasi.setMode("r","Hepburn") # default: use Hepburn Roman table
+        kakasi.setMode("s", True) # add space, default: no separator
+        kakasi.setMode("C", False) # capitalize, default: no capitalize
+        converters = (kakasi, kakasi.getConverter())
+
+    return converters
 
 #################################################
 
 class Song:
-    def __init__(self, song, artist, bpm, key, links):
-        self.song = song
-        self.artist = artist
-        self.bpm = bpm
-        self.key = key
-        self.links = {}
+    """
+    Everything the bot serves about one song. Built once per catalog by
+    get_songs and read-only from then on; slotted so a catalog of them takes
+    far less memory than the DataFrame it came from.
+
+    title is the title as listed on the site, song the one shown and
+    searched for, which has the artist appended if several songs share the
+    title. levels holds the EASY, HARD, CHAOS and GLITCH levels (0 where
+    there is no such chart) and links the matching chart pages (None where
+    missing).
+    """
+    __slots__ = ('song', 'artist', 'bpm', 'character', 'key',
+                    'key_j', 'hiragana', 'katakana', 'levels', 'links', 'title')
+
+    def __init__(self, song, artist, bpm, character, key, key_j = "", hiragana = "", 
+                    katakana = "", levels = (0, 0, 0, 0), links = (None,) * 4, title = None):
+        values = (song, artist, bpm, character, key, key_j, hiragana, katakana, 
+                    tuple(levels), tuple(links), song if title is None else title)
+
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Song is read-only.")
+
+    def __reduce__(self):
+        return (Song, song_values(self))
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, Song) and song_values(self) == song_values(other))
+
+    def __hash__(self):
+        return hash(song_values(self))
+
+    def __repr__(self):
+        return f"Song({self.song!r}, key = {self.key!r})"
+
+    def replace(self, **fields):
+        """
+        :return: Copy of the song with the given fields changed
+        """
+
+        values = dict(zip(self.__slots__, song_values(self)))
+        values.update(fields)
+
+        return Song(**values)
 
-    def set_links(self, links_dict):
-        self.links = links_dict
+# every field of a song as a tuple, for comparing and hashing songs by value
+song_values = attrgetter(*Song.__slots__)
 
 #################################################
 
-def get_table(SOURCE):
+def get_key(link, diff):
     """
-    Scrapes the main table from the ct2viewer website. 
-    Used for grabbing song links since pd.html doesn't also scrape hyperlinks.
-    
-    :param SOURCE: ct2viewer site link
-    :return: HTML table
+    All songs from the site are formatted in this manner:
+    https://ct2view.the-kitti.com/chartlist/<song identifier>/<difficulty>
+
+    This function returns the song identifier (key) of a link using the
+    regexes in utils.
+
+    :param link: Link to a chart page
+    :param diff: Difficulty the link belongs to
+    :return: Key of the song, or None if the link doesn't match
+    """
+
+    keys = utils.REGEXES_BY_DIFF[diff].findall(link)
+
+    return " ".join(keys[0].split("_")) if keys else None
+
+def get_column_names(headers):
+    """
+    Names duplicate headers the same way pd.read_html does (Lv., Lv..1 ...)
+    and renames them to the columns used throughout the bot.
+
+    :param headers: List of header cell texts
+    :return: List of column names
+    """
+
+    counts = Counter()
+    columns = []
+
+    for header in headers:
+        columns.append(f"{header}.{counts[header]}" if counts[header] else header)
+        counts[header] += 1
+
+    return [utils.COLUMN_NAMES.get(column, column) for column in columns]
+
+def get_span(cell, name):
+    """
+    :param cell: lxml element of a table cell
+    :param name: 'colspan' or 'rowspan'
+    :return: Number of columns/rows the cell spans
     """
 
     try:
-        r = requests.get(SOURCE)
-        c2v = BeautifulSoup(r.content, features = 'lxml')
-        table = c2v.body.table.tbody
+        return max(1, int(cell.get(name, 1)))
+    except ValueError:
+        return 1
 
-        return table
-    
-    except:
-        return Exception("Unable to request from page.")
+def get_cells(tr, carried):
+    """
+    Reads the cells of a table row the way pd.read_html does, repeating a
+    cell spanning several columns (colspan) or rows (rowspan) in each of
+    them, so merged cells don't shift the columns after them.
+
+    :param tr: lxml element of the table row
+    :param carried: Dictionary in the format {<column> : [<rows left>, <text>]}
+                    of cells spanning down from earlier rows, updated in place
+    :return: List of cell texts, None for empty cells
+    """
+
+    cells = []
+
+    def fill_carried():
+        while (column := len(cells)) in carried:
+            cells.append(carried[column][1])
+            carried[column][0] -= 1
+
+            if carried[column][0] == 0:
+                del carried[column]
+
+    for td in tr.iterfind('td'):
+        fill_carried()
+        text = td.text_content().strip() or None
+        rowspan = get_span(td, 'rowspan')
+
+        for _ in range(get_span(td, 'colspan')):
+            if rowspan > 1:
+                carried[len(cells)] = [rowspan - 1, text]
+
+            cells.append(text)
+
+    fill_carried()
+
+    return cells
 
-def get_initial_df(SOURCE):
+def parse_chartlist(content):
     """
-    Reads all relevant information from the site to a dataframe.
+    Reads all relevant information from the chartlist page in a single pass
+    over the table. Every row's chart links are read from the same row, so
+    each song is paired with its own key.
 
-    :param SOURCE: ct2viewer site link
+    :param content: HTML of the ct2viewer chartlist page
     :return: pandas DataFrame object containing information such as song titles,
-            artist names, DIFFICULTIES, BPMs and so on.
-    """ 
+            artist names, DIFFICULTIES, BPMs, keys and so on, and a dictionary
+            of dictionaries in the format:
+            {<difficulty> : {<key> : <link>}}
+    """
+
+    import lxml.html
+    import pandas as pd
+
+    if isinstance(content, bytes):
+        content = content.decode("UTF-8")
+
+    page = lxml.html.fromstring(content)
+
+    rows = []
+    keys = []
+    merged_dict = {diff: {} for diff in utils.REGEXES_BY_DIFF.keys()}
+
+    for table in page.iter('table'):
+        header_rows = table.xpath('.//tr[th]')
+
+        if not header_rows:
+            continue
+
+        columns = get_column_names([th.text_content().strip() 
+                        for th in header_rows[0].iterfind('th')
+                        for _ in range(get_span(th, 'colspan'))])
+        carried = {}
+
+        for tr in table.xpath('.//tr[td]'):
+            row = dict(zip(columns, get_cells(tr, carried)))
 
-    charts_df = pd.read_html(SOURCE, encoding = "UTF-8")
-    charts_df = pd.concat(charts_df)
-    charts_df.rename(columns = {"Lv.":"Diff_E","Lv..1":"Diff_H",
-        "Lv..2":"Diff_C","Lv..3":"Diff_G"
-        ,"Chart Page":"Chart_E","Chart Page.1":"Chart_H"
-        ,"Chart Page.2":"Chart_C","Chart Page.3":"Chart_G"
-        ,"Chart Page.4":"Chart_CR"}, inplace = True)
+            if row.get('Song') is None:
+                continue
 
-    charts_df = charts_df[charts_df['Song'].notna()]
+            row_key = None
 
-    return charts_df
+            for a in tr.iterfind('.//a'):
+                link = f"{a.get('href')}.html"
+
+                for diff in utils.REGEXES_BY_DIFF.keys():
+                    if diff in link and (key := get_key(link, diff)) is not None:
+                        merged_dict[diff][key] = link
+
+                        # all unique keys are present only for CHAOS difficulty 
+                        # since the site does not include most EASY/HARD views
+                        if diff == 'chaos.html':
+                            row_key = key
+
+            # same as the inner merge used to, songs without a CHAOS chart are dropped
+            if row_key is None:
+                continue
+
+            rows.append(row)
+            keys.append(row_key)
+
+    charts_df = pd.DataFrame(rows)
+
+    # same type inference as pd.read_html, i.e. levels become floats
+    for column in charts_df.columns:
+        try:
+            charts_df[column] = pd.to_numeric(charts_df[column])
+        except (ValueError, TypeError):
+            pass
+
+    charts_df['Key'] = keys
+
+    return charts_df, merged_dict
 
 #################################################
 
-def get_links_by_difficulty(table):
+def romanize(song):
     """
-    Formats all links from the HTML table obtained earlier and puts them
-    into a dictionary.
+    Runs pykakasi on a Japanese title.
 
-    :param table: HTML table
-    :return: Dictionary in the format: {<difficulty> : [list of <links>]}
+    :param song: Title of the song
+    :return: Dictionary of the title's Hepburn romanization (as used for 
+            Key_J), hiragana and katakana readings
     """
 
-    links = [link.get('href') for link in table.find_all('a')]
-    linksFormatted = [f"{link}.html" for link in links]
+    kakasi, conv = get_converters()
+    items = kakasi.convert(song)
 
     return {
-            diff: [link for link in linksFormatted if diff in link] 
-                    for diff in utils.REGEXES_BY_DIFF.keys()
-            }
-    
+        'hepburn': conv.do(song),
+        'hiragana': "".join(item['hira'] for item in items),
+        'katakana': "".join(item['kana'] for item in items),
+    }
 
-def get_keys_by_difficulty(links_dict):
+def load_romanizations(path = utils.ROMANIZATION_PATH):
+    """
+    :param path: Location of the romanization cache
+    :return: Dictionary in the format {<title> : <output of romanize>}
     """
-    All songs from the site are formatted in this manner:
-    https://ct2view.the-kitti.com/chartlist/<song identifier>/<difficulty>
 
-    This function returns all unique song identifiers (keys) present for 
-    each difficulty using the regexes from earlier.
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            return json.load(f)
 
-    :param links_dict: Dictionary of links by difficulty
-    :return: Dictionary in the format: {<difficulty> : [list of <keys>]}
-    """
+    except (OSError, ValueError):
+        return {}
 
-    keys_dict = dict()
+def save_romanizations(romanizations, path = utils.ROMANIZATION_PATH):
+    tmp_path = f"{path}.tmp"
 
-    for diff, regex in utils.REGEXES_BY_DIFF.items():
-        result = [" ".join(key.split("_")) for link in links_dict[diff] 
-                        for key in regex.findall(link)]
-        keys_dict[diff] = result
+    with open(tmp_path, 'w', encoding = 'utf-8') as f:
+        json.dump(romanizations, f, ensure_ascii = False)
 
-    return keys_dict
+    os.replace(tmp_path, path)
 
-def merge_keys_and_links(table):
+def romanize_song(song, romanizations):
     """
-    Helper function. Merges links_dict and keys_dict
+    Fills in the romanized title and kana readings of a Japanese-titled
+    song. Other songs are returned as they are.
 
-    :param table: HTML table scraped from site
-    :return: Dictionary of dictionaries in the format: 
-            {<difficulty> : [list of dictionaries {<key> : <link>}]}
+    :param song: Song object straight from get_records
+    :param romanizations: Cache from load_romanizations, pykakasi only runs 
+                          for titles missing from it. Updated in place.
+    :return: Song object
     """
 
-    links_dict = get_links_by_difficulty(table)
-    keys_dict = get_keys_by_difficulty(links_dict)
- 
-    return {k: dict(zip(keys_dict[k], links_dict[k])) for k in keys_dict}
+    # if title is in japanese
+    if not re.search(utils.JP_REGEX, song.title):
+        return song
 
-#################################################
+    if song.title not in romanizations:
+        romanizations[song.title] = romanize(song.title)
+
+    readings = romanizations[song.title]
 
-def merge_data(charts_df, merged_dict):
+    return song.replace(key_j = readings['hepburn'], hiragana = readings['hiragana'],
+                            katakana = readings['katakana'])
+
+def handle_duplicates(songs):
     """
-    Create a new DataFrame object containing song keys to be merged with
-    the original DataFrame.
+    Pre-processing function to handle songs that have identical titles.
+    :param songs: List of Song objects
+    :return: List of Song objects, with duplicate song titles being in the
+            format <Song> (<Artist>)
+    """
+
+    counts = Counter(song.title for song in songs)
+    handled = []
 
-    :param charts_df: Original DataFrame containing information about each
-                      chart, excluding unique song keys.
-    :param merged_dict: Dictionary of dictionaries previously obtained
-                        containing DIFFICULTIES and their corresponding
-                        keys/links.
+    for song in songs:
+        # append the artist's name in brackets
+        name = f"{song.title} ({song.artist})" if counts[song.title] > 1 else song.title
+        handled.append(song if song.song == name else song.replace(song = name))
 
-    :return: New DataFrame now with each song's corresponding unique key. 
+    return handled
+
+def get_text(value):
+    """
+    Helper function. Cell values as shown on the site: missing cells become
+    empty strings, and whole numbers lose the .0 pandas gave them.
     """
 
-    # all unique keys are present only for CHAOS difficulty since the site
-    # does not include most EASY/HARD difficulty views
-    links_df = pd.DataFrame({
-                            'Song' : charts_df.Song, 
-                            'Artist' : charts_df.Artist, 
-                            'Key' : list(merged_dict['chaos.html'].keys()), 
-                            })
+    if value is None or value != value:
+        return ""
 
-    links_df.to_csv("links.csv")
-    charts_df.to_csv("charts.csv")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
 
-    return pd.merge(
-            left = charts_df, right = links_df, 
-            left_on = ['Song', 'Artist'], 
-            right_on = ['Song', 'Artist']
-        )
+    return str(value)
 
-def get_romanized_titles(merged_df):
+def get_level(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return 0
+
+def get_records(charts_df, merged_dict):
     """
-    Create new column in the DataFrame for ONLY Japanese-titled songs.
-    This column contains the romanized title of the song obtained from pykakasi.
+    Converts the rows of the chartlist into compact records holding only
+    what the site lists, so nothing after parsing needs pandas.
 
-    :param merged_df: Merged DataFrame containing all relevant song info
-    :return: Same DataFrame but now with romanized titles
+    :param charts_df: DataFrame from parse_chartlist
+    :param merged_dict: Dictionary of links from parse_chartlist
+    :return: List of Song objects in catalog order, not romanized yet
     """
-    for song in merged_df.Song:
-        # if title is in japanese
-        if utils.JP_REGEX.findall(song):
-            # assign japanese title
-            merged_df.loc[merged_df.Song == song, 'Key_J'] = conv.do(song)
 
-        else: 
-            # fill other rows with whitespace as opposed to NaN by default
-            merged_df.loc[merged_df.Song == song, 'Key_J'] = ""
+    columns = {column: charts_df[column].tolist() if column in charts_df else [None] * len(charts_df)
+                for column in ['Song', 'Artist', 'BPM', 'Character', 'Key',
+                                *utils.LEVEL_COLUMNS.values()]}
+
+    songs = []
+
+    for row in range(len(charts_df)):
+        key = columns['Key'][row]
+        title = get_text(columns['Song'][row])
+
+        songs.append(Song(
+                song = title,
+                title = title,
+                artist = get_text(columns['Artist'][row]),
+                bpm = get_text(columns['BPM'][row]),
+                character = get_text(columns['Character'][row]),
+                key = key,
+                levels = [get_level(columns[column][row]) 
+                            for column in utils.LEVEL_COLUMNS.values()],
+                links = [merged_dict[diff].get(key) for diff in utils.REGEXES_BY_DIFF]
+            ))
 
-    return merged_df
+    return songs
 
-def handle_duplicates(merged_df):
+#################################################
+
+# fields of a song that come from the site, plus the title it's shown as
+SITE_FIELDS = ('title', 'artist', 'bpm', 'character', 'levels', 'links')
+CHANGE_FIELDS = ('song',) + SITE_FIELDS
+
+def match_songs(previous, records):
     """
-    Pre-processing function to handle songs that have identical titles.
-    :param merged_df: DataFrame containing all relevant song info
-    :return: Same DataFrame but with duplicate song titles being in the
-            format <Song> (<Artist>)
+    Pairs every record with the song of the same key in the previous
+    catalog. Keys the site repeats are paired in order of appearance.
+
+    :param previous: Songs of the previous catalog
+    :param records: Output of get_records
+    :return: Tuple of (list aligned with records holding the previous Song
+             or None, list of previous Songs left unpaired)
     """
 
-    # if there are duplicates
-    if merged_df.duplicated(subset = ['Song']).any():
-        duplicated = merged_df.duplicated(subset = ['Song'])
-        
-        # get a list of these duplicates
-        song_duplicates = list(merged_df[duplicated].to_records())
-        
-        for dupe in song_duplicates:
-            # get index of each song with the same title
-            indexes = merged_df.index[merged_df.Song == dupe.Song].tolist()
+    by_key = defaultdict(list)
+    for song in previous:
+        by_key[song.key].append(song)
+
+    matched = [by_key[record.key].pop(0) if by_key.get(record.key) else None 
+                for record in records]
+    removed = [song for songs in by_key.values() for song in songs]
 
-        # pandas doesn't allow assignment during iteration
-        for index in indexes:
-            # append the artist's name in brackets
-            merged_df.loc[index, 'Song'] += f" ({merged_df.loc[index].Artist})"
-            
-    return merged_df
+    return matched, removed
 
-def get_merged_df(charts_df, merged_dict):
+def get_changes(songs, matched, removed):
     """
-    Helper function to obtain and perform all necessary preprocessing steps on 
-    the merged DataFrame.
+    :param songs: Songs of the new catalog
+    :param matched: Previous version of each song, from match_songs
+    :param removed: Previous songs no longer listed, from match_songs
+    :return: Change log in the format {'added': [<key>], 'removed': [<key>],
+             'changed': {<key> : {<field> : [<old value>, <new value>]}}}
+    """
+
+    changes = {'added': [], 'removed': [song.key for song in removed], 'changed': {}}
+
+    for song, old in zip(songs, matched):
+        if old is None:
+            changes['added'].append(song.key)
+            continue
+
+        fields = {field: [getattr(old, field), getattr(song, field)] for field in CHANGE_FIELDS
+                    if getattr(old, field) != getattr(song, field)}
+
+        if fields:
+            changes['changed'][song.key] = fields
 
-    :param charts_df: Original DataFrame containing information about each
-                      chart, excluding unique song keys.
-    :param merged_dict: Dictionary of dictionaries previously obtained
-                        containing DIFFICULTIES and their corresponding
-                        keys/links.
-    :return: Final merged DataFrame containing unique keys, romanized keys 
-            for songs with Japanese titles, and duplicates handled accordingly.
+    return changes
+
+def get_songs(charts_df, merged_dict, previous = (), romanizations = None):
+    """
+    Helper function to obtain and perform all necessary preprocessing steps on
+    the parsed chartlist. Songs listed exactly as in the previous catalog are
+    carried over as they are, so only new or changed songs get romanized.
+
+    :param charts_df: DataFrame containing information about each chart
+                      and its unique song key, from parse_chartlist.
+    :param merged_dict: Dictionary of links from parse_chartlist
+    :param previous: Songs of the catalog being replaced, if any
+    :param romanizations: Romanization cache, see romanize_song
+    :return: Tuple of (tuple of Song objects in catalog order, with romanized
+             keys for songs with Japanese titles and duplicates handled 
+             accordingly, change log from get_changes)
     """
+    if romanizations is None:
+        romanizations = {}
+
+    records = get_records(charts_df, merged_dict)
+    matched, removed = match_songs(previous, records)
+
+    songs = [old if old is not None and all(getattr(old, field) == getattr(record, field) 
+                                                for field in SITE_FIELDS)
+                else romanize_song(record, romanizations)
+                for record, old in zip(records, matched)]
 
-    merged_df = merge_data(charts_df, merged_dict)
-    merged_df = get_romanized_titles(merged_df)
-    merged_df = handle_duplicates(merged_df)
+    songs = handle_duplicates(songs)
 
-    return merged_df
+    return tuple(songs), get_changes(songs, matched, removed)
 
 #################################################
 
-def compare_fuzz(song, best_matches, best_fuzz_ratio, fuzz_value):
+def parse_difficulty_query(arg):
     """
-    compare_fuzz: A helper function to compare fuzz values then add it to 
-    the best_matches array, if needed
-    :param song: The song to potentially add
-    :param best_matches: A list of best matches
-    :param best_fuzz_ratio: The currently best fuzz ratio
-    :param fuzz_value: Fuzz ratio of the song compared to user's query
-    :return: True if the fuzz_ratio was better and needs to be updated
-             False if the fuzz_ratio does not need to be modified
+    Reads the arguments of !c2d: a level or range of levels, optionally 
+    followed by difficulties to filter by and/or how to sort, 
+    e.g. "14", "13-15", "13-15 chaos glitch bpm".
+    :param arg: User input
+    :return: Tuple of (lowest level, highest level, list of difficulties or
+             None for all, sort order or None)
+    :raises ValueError: If the levels are not numbers or out of range
     """
 
-    # If fuzz_value is greater than best_fuzz ratio, set best to fuzz_value and set best_matches to only that song
-    if fuzz_value > best_fuzz_ratio:
-        best_matches.clear()
-        best_matches.append(song)
-        return True
+    levels, *options = arg.lower().split()
 
-    # Otherwise, if fuzz and best are equal, add the song to the list
-    elif fuzz_value == best_fuzz_ratio:
-        best_matches.append(song)
-        return False
+    try:
+        low, _, high = levels.partition("-")
+        low, high = int(low), int(high or low)
+    
+    except ValueError:
+        raise ValueError("Not a number.")
+
+    if not utils.MIN_LEVEL <= low <= high <= utils.MAX_LEVEL:
+        raise ValueError("Not within correct difficulty range.")
 
-    return False
+    difficulties = [option for option in options if option in utils.LEVEL_COLUMNS]
+    sorts = [option for option in options if option in ('level', 'bpm')]
 
+    return low, high, difficulties or None, sorts[-1] if sorts else None
 
-def search_song(df, query):
+def search_difficulty(level_index, low, high = None, difficulties = None, sort = None):
     """
-    search_song: Fetches the closest matching song from the database
-                    - If multiple are found, return a list of potential songs
-    :param df: DataFrame object to obtain info of search result
-    :param query: A query in string format, usually the name of a song
-    :return: DataFrame object containing all information about the song
+    Lists every song with a chart in the requested levels.
+    :param level_index: LevelIndex of the catalog
+    :param low, high, difficulties, sort: See LevelIndex.search
+    :return: List of pages, see get_pages
     """
-    best_fuzz_ratio = 0
-    best_matches = []
+    rows = level_index.search(low, high, difficulties, sort)
 
-    # check if input is japanese
-    is_japanese = re.search(JP_REGEX, query)
-    
-    for index, row in df.iterrows():
-        # if there is an exact match simply return it
-        if row.Song.lower() == query.lower():
-                return df.loc[df.Song == row.Song]
+    return get_pages([level_index.songs[row] for row in rows])
 
-        # check against the Song attribute regardless if input is in EN/JP
-        fuzz_value = fuzz.token_set_ratio(row.Song, query)
+def get_pages(output, size = utils.PAGE_CHARS):
+    """
+    Packs a list of song titles into as few pages as possible, each page
+    listing as many titles as fit in size characters.
+    :param output: List of song titles
+    :param size: Most characters on a page
+    :return: List of pages, each a string of comma separated titles
+    """
+    pages = []
+    page = ""
 
-        if compare_fuzz(row, best_matches, best_fuzz_ratio, fuzz_value):
-            best_fuzz_ratio = fuzz_value
-            
-        if not is_japanese:
-            # also check if input is romanized Japanese
-            fuzz_value_romanized = fuzz.token_set_ratio(row.Key_J, query)
-            
-            if compare_fuzz(row, best_matches, best_fuzz_ratio, fuzz_value_romanized):
-                best_fuzz_ratio = fuzz_value_romanized
+    for title in output:
+        if page and len(page) + len(", ") + len(title) > size:
+            pages.append(page)
+            page = ""
 
-    # if there are no good matches, return nothing
-    if best_fuzz_ratio < 0.2:
-        return []
+        page = f"{page}, {title}" if page else title
 
-    # removes duplicates from search
-    songs = set([song.Song for song in best_matches])
-    output = [df.loc[df.Song == song] for song in songs]
+    if page:
+        pages.append(page)
 
-    return output
+    return pages
 
+def embed_pages(pages, title):
+    """
+    :param pages: Output of get_pages
+    :param title: Title shown above every page
+    :return: List of discord.Embed objects, one per page
+    """
+    embeds = []
 
-def search_difficulty(df, query):
-    output = []
+    for i, page in enumerate(pages):
+        embed = discord.Embed(title = title, description = page, color = 0x1abc9c)
 
-    for index, row in df.iterrows():
-        if (row.Diff_E == query or row.Diff_H == query 
-            or row.Diff_C == query or row.Diff_G == query):
-            
-            output.append(row.Song)
+        if len(pages) > 1:
+            embed.set_footer(text = f"Page {i + 1}/{len(pages)}")
 
-    partitioned_output = [output[i : i + 6] for i in range(0, len(output), 6)]
-    print(partitioned_output)
+        embeds.append(embed)
 
-    return partitioned_output
+    return embeds
 
 #################################################
 
-def get_images(link):
+def parse_queries(arg, limit = utils.BATCH_QUERY_LIMIT):
     """
-    Gets the song artwork and character logo from the link of a song.
-    :param link: Link to scrape thumbnail from
-    :return: Link to artwork and logo in proper format
+    Reads the arguments of !c2m: song names separated by new lines or
+    semicolons, e.g. a tournament pool pasted as is.
+    :param arg: User input
+    :param limit: Most queries accepted at once
+    :return: List of queries, see utils.normalize_query
+    :raises ValueError: If there are no queries or too many
     """
 
-    r = requests.get(link)
-    page = BeautifulSoup(r.content, features = 'lxml')
-    images = page.find_all('img')
+    queries = [query for part in re.split(r"[\n;]", arg) 
+                    if (query := utils.normalize_query(part))]
 
-    # very hacky code based on the way the site's images are formatted.
-    # not sure how to improve
-    artwork = "".join(image['src'] for image in images if 'thumbnail' in image['src'])
+    if not queries:
+        raise ValueError("No songs given.")
 
-    if (root := "../..") in artwork:
-        artwork = artwork.replace(root, utils.PREFIX)
-    else:
-        artwork = utils.PREFIX + artwork
+    if len(queries) > limit:
+        raise ValueError(f"At most {limit} songs can be searched at once.")
 
-    return artwork
+    return queries
 
-def embed_song(merged_dict, song):
+def handle_levels_string(levels, links):
+    """
+    Helper function. Short form of a song's levels, e.g. E4 H9 C14 G15.
+    :param levels: Levels of the song's EASY, HARD, CHAOS and GLITCH charts
+    :param links: Links of the same charts, None where there is no chart
+    """
+    return " ".join(f"{diff[0].upper()}{level}" 
+                        for diff, level, link in zip(utils.LEVEL_COLUMNS, levels, links)
+                        if link is not None)
+
+def embed_many(songs, queries, results):
+    """
+    Outputs the results of a batch search as a single table, one line per
+    query: the song it found and its levels, the songs it could be, or that
+    nothing was found.
+    :param songs: Songs of the catalog the search was run against
+    :param queries: List of queries searched
+    :param results: Output of SearchIndex.search_many
+    :return: Formatted discord.Embed object
+    """
+
+    rows = []
+
+    for query, matches in zip(queries, results):
+        best_matches = search.get_best_matches(matches)
+
+        if len(query) > utils.BATCH_QUERY_CHARS:
+            query = query[:utils.BATCH_QUERY_CHARS - 1] + "\u2026"
+
+        if len(best_matches) == 1:
+            song = songs[best_matches[0].row]
+            rows.append((query, song.song, song.links[2], 
+                            handle_levels_string(song.levels, song.links)))
+
+        elif best_matches:
+            titles = [songs[match.row].song for match in best_matches]
+            rows.append((query, None, None, "one of " + ", ".join(titles)))
+
+        else:
+            rows.append((query, None, None, "no songs found"))
+
+    def format_rows(linked):
+        lines = []
+
+        for i, (query, title, link, details) in enumerate(rows, 1):
+            if title is None:
+                lines.append(f"`{i:>2}` {query} \u2192 *{details}*")
+            elif linked:
+                lines.append(f"`{i:>2}` {query} \u2192 [{title}]({link}) {details}")
+            else:
+                lines.append(f"`{i:>2}` {query} \u2192 **{title}** {details}")
+
+        return "\n".join(lines)
+
+    # chart links are dropped if they don't all fit in one embed
+    description = format_rows(linked = True)
+
+    if len(description) > utils.PAGE_CHARS:
+        description = format_rows(linked = False)[:utils.PAGE_CHARS]
+
+    return discord.Embed(title = f"Results for {len(rows)} songs", 
+                            description = description, color = 0x1abc9c)
+
+#################################################
+
+def embed_song(song, artwork = None):
     """
     Outputs details of a song including the song's title, its artist, BPM
     and hyperlinks to each of its (available) charts.
-    :param merged_dict: Dictionary to find a chart's links
+    :param song: Song object to describe
+    :param artwork: Link to the song's artwork, already resolved
     :return: Formatted discord.Embed object
     """
-    
-    song = song.to_records()
-    
-    # obtain all available links to song
-    links = [merged_dict[diff].get("".join(song.Key)) 
-                for diff in utils.REGEXES_BY_DIFF.keys()]
 
-    # since each song is guaranteed to have a CHAOS chart on the site
-    # grab the thumbnail from the CHAOS link
-    artwork = get_images(links[2])
+    embed = discord.Embed(title = song.song, color = 0x1abc9c)
 
-    embed = discord.Embed(title = f'{"".join(song.Song)}', color = 0x1abc9c)
-    embed.set_thumbnail(url = artwork)
+    if artwork is not None:
+        embed.set_thumbnail(url = artwork)
 
-    embed.add_field(name = "Artist", value = f'{"".join(song.Artist)}', inline = False)
-    embed.add_field(name = "BPM", value = f'{"".join(song.BPM)}', inline = True)
-    embed.add_field(name = "Character", value = f'{"".join(song.Character)}', inline = True)
+    embed.add_field(name = "Artist", value = song.artist, inline = False)
+    embed.add_field(name = "BPM", value = song.bpm, inline = True)
+    embed.add_field(name = "Character", value = song.character, inline = True)
 
-    difficulty_string = handle_difficulty_string(song, links)
+    difficulty_string = handle_difficulty_string(song.levels, song.links)
 
     embed.add_field(name = "Difficulty", value = difficulty_string, inline = False)
         
     return embed
 
-def handle_difficulty_string(song, links):
+def handle_difficulty_string(levels, links):
     """
     Helper function. Returns a string that is formatted according to Discord's
     hyperlink syntax.
-    :param song: song to return difficulty information of
+    :param levels: Levels of the song's EASY, HARD, CHAOS and GLITCH charts
     :param links: URL(s) containing links to view each difficulty's chart
     """
     difficulty_string = ""
@@ -383,51 +677,73 @@ def handle_difficulty_string(song, links):
     # obtain links and output in discord hyperlink format, i.e.
     # [text here](url here)
     if links[0] is not None:
-        difficulty_string += f'[EASY {"".join(str(int(song.Diff_E)))}]({links[0]})'
+        difficulty_string += f'[EASY {levels[0]}]({links[0]})'
         difficulty_string += " | "
     
     if links[1] is not None:
-        difficulty_string += f'[HARD {"".join(str(int(song.Diff_H)))}]({links[1]})'
+        difficulty_string += f'[HARD {levels[1]}]({links[1]})'
         difficulty_string += " | "
         
-    difficulty_string +=  f'[CHAOS {"".join(str(int(song.Diff_C)))}]({links[2]})'
+    difficulty_string +=  f'[CHAOS {levels[2]}]({links[2]})'
 
     if links[3] is not None:
         difficulty_string += " | "
-        difficulty_string += f'[GLITCH {"".join(str(int(song.Diff_G)))}]({links[3]})'
+        difficulty_string += f'[GLITCH {levels[3]}]({links[3]})'
 
     return difficulty_string
 
-def process_search(merged_dict, search_result):
+def process_search(songs, matches, artwork_cache = None):
     """
     Helper function. Returns different outputs depending on the search result.
-    :param merged_dict: Dictionary to obtain song links from
-    :param search_result: Result of the function search_song
+    :param songs: Songs of the catalog the search was run against
+    :param matches: Ranked matches returned by SearchIndex.search
+    :param artwork_cache: ArtworkCache to take the song's artwork from
     :return: Appropriate discord.Embed object
     """
-    print("search result")
-    print(search_result)
-    print(type(search_result))
-    result = search_result.to_frame()
-    print("post conversion")
-    print(result)
-    print(type(result))
-    if len(result) == 0:
+    best_matches = search.get_best_matches(matches)
+
+    if len(best_matches) == 0:
         return utils.generate_embed(
                     status = 'Error', 
                     msg =  """No songs found. There could be an error with
                                         your search or the bot."""
                 )
 
-    elif len(result) == 1:
-        return embed_song(merged_dict, result)
+    elif len(best_matches) == 1:
+        song = songs[best_matches[0].row]
+        artwork = None
+
+        if artwork_cache is not None:
+            artwork = artwork_cache.get(song.key)
+
+        return embed_song(song, artwork)
         
-    elif len(result) > 1:
-        results = [row.Song for index, row in result.iterrows()]
+    elif len(best_matches) > 1:
+        results = [songs[match.row].song for match in best_matches]
         
         return utils.generate_embed(
                     status = 'Error',
                     msg = """Too many songs found. Please enter
                             a song from the list given.""" + "\r\n" 
                             + "\r\n".join(results)
-                )
\ No newline at end of file
+                )
+
+def embed_score(result):
+    """
+    Outputs the result of a play read from a screenshot.
+    :param result: Output of OCREngine.process
+    :return: Formatted discord.Embed object
+    """
+
+    embed = discord.Embed(title = result.get('song') or result['title'] or "Unknown song", 
+                            color = 0x1abc9c)
+
+    embed.add_field(name = "Score", value = f"{result['score']}", inline = True)
+    embed.add_field(name = "TP", value = f"{result['tp']}", inline = True)
+
+    judgements = " | ".join(f"{judgement.upper()} {count}" 
+                    for judgement, count in result['judgements'].items())
+    embed.add_field(name = "Judgements", value = judgements, inline = False)
+
+    return embed
+
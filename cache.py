@@ -0,0 +1,258 @@
+from collections import OrderedDict
+
+import asyncio
+import json
+import os
+import utils
+
+#################################################
+
+class QueryCache:
+    """
+    Least recently used cache of finished search results, keyed by the 
+    normalized query. Every entry is tagged with the version of the catalog
+    it was computed from, and a lookup against any other version misses, so
+    swapping in a new catalog invalidates the whole cache at once.
+    """
+    def __init__(self, max_size = utils.QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, version, query):
+        """
+        :param version: Version of the catalog currently in use
+        :param query: Normalized query
+        :return: Cached value, or None on a miss
+        """
+
+        if version != self.version or query not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(query)
+
+        return self.entries[query]
+
+    def put(self, version, query, value):
+        """
+        :param version: Version of the catalog the value was computed from
+        :param query: Normalized query
+        :param value: Value to cache
+        """
+
+        if version != self.version:
+            self.entries = OrderedDict()
+            self.version = version
+
+        self.entries[query] = value
+        self.entries.move_to_end(query)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def stats(self):
+        """
+        :return: Dictionary of the cache's size and hit/miss counters
+        """
+
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+#################################################
+
+class OCRCache:
+    """
+    Least recently used cache of screenshot OCR results, found by the exact
+    hash of the file. Results of screenshots with a perceptual hash within
+    a few bits of another's can be looked up too, but only tell which song
+    it shows: the score and judgements are small enough that two different
+    plays of a song hash almost the same. Optionally persisted as JSON.
+    """
+    def __init__(self, max_size = utils.OCR_CACHE_SIZE, max_distance = utils.OCR_HASH_DISTANCE,
+                    path = None):
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.path = path
+        self.entries = OrderedDict()
+        self.unsaved = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, digest):
+        return digest in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, digest):
+        """
+        :param digest: Hash of the image file
+        :return: Cached result, or None on a miss
+        """
+
+        if digest not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(digest)
+
+        return self.entries[digest][1]
+
+    def get_similar(self, phash):
+        """
+        :param phash: Perceptual hash of the image
+        :return: Cached result of a screenshot that looks almost the same, 
+                 which is only good for telling the song, or None
+        """
+
+        for digest, (other, result) in self.entries.items():
+            if (phash ^ other).bit_count() <= self.max_distance:
+                self.entries.move_to_end(digest)
+                return result
+
+        return None
+
+    def put(self, digest, phash, result):
+        """
+        :param digest: Hash of the image file
+        :param phash: Perceptual hash of the image
+        :param result: OCR result to cache
+        """
+
+        self.entries[digest] = (phash, result)
+        self.entries.move_to_end(digest)
+        self.unsaved += 1
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def load(self):
+        if self.path is None:
+            return
+
+        try:
+            with open(self.path, encoding = 'utf-8') as f:
+                entries = json.load(f)
+
+        except (OSError, ValueError):
+            return
+
+        for digest, (phash, result) in entries.items():
+            self.put(digest, phash, result)
+
+        self.unsaved = 0
+
+    def save(self, entries = None):
+        """
+        :param entries: Copy of self.entries to write instead, see save_periodically
+        """
+
+        if self.path is None:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(self.entries if entries is None else entries, f, ensure_ascii = False)
+
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        """
+        :return: Dictionary of the cache's size and hit/miss counters
+        """
+
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+#################################################
+
+async def save_periodically(caches, interval = utils.CACHE_SAVE_INTERVAL):
+    """
+    Saves every cache with unsaved entries each interval seconds, instead
+    of rewriting the whole file after every miss. The entries are copied on
+    the event loop and written out in a thread, so saving neither blocks
+    the loop nor sees the cache change halfway through.
+
+    :param caches: List of caches with entries, unsaved and save(entries)
+    :param interval: Seconds between saves
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        await asyncio.sleep(interval)
+
+        for cache in caches:
+            if not cache.unsaved:
+                continue
+
+            entries = OrderedDict(cache.entries)
+            cache.unsaved = 0
+
+            await loop.run_in_executor(None, cache.save, entries)
+
+#################################################
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one: the first caller
+    starts the work and later ones wait on the same task until it finishes,
+    all getting its result or exception. Waiters are shielded, so one being
+    cancelled doesn't cancel the work the others are waiting on.
+    """
+    def __init__(self):
+        self.tasks = {}
+        self.shared = 0
+
+    def __len__(self):
+        return len(self.tasks)
+
+    async def run(self, key, function):
+        """
+        :param key: Hashable identifying the work
+        :param function: Coroutine function taking no arguments, only called
+                         if no work with the same key is in flight
+        :return: Result of the work
+        """
+
+        if (task := self.tasks.get(key)) is None:
+            task = asyncio.ensure_future(function())
+            self.tasks[key] = task
+            task.add_done_callback(lambda task: self.finish(key, task))
+
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(task)
+
+    def finish(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+        # retrieved here in case every waiter was cancelled, otherwise
+        # asyncio would warn that the exception was never retrieved
+        if not task.cancelled():
+            task.exception()
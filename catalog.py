@@ -0,0 +1,349 @@
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import c2v
+import metrics
+import search
+import utils
+
+# bump whenever the pickled layout changes so stale snapshots get rebuilt
+SNAPSHOT_VERSION = 5
+
+#################################################
+
+class Catalog:
+    """
+    Fully preprocessed song data used by the bot, along with the HTTP
+    validators of the page it was built from. Songs are kept as compact
+    c2v.Song records in catalog order, so a search's rows index straight
+    into self.songs and serving never touches pandas. The search, level and
+    prefix indexes are rebuilt from the songs rather than stored in the 
+    snapshot.
+
+    version identifies the page contents the catalog was built from, so
+    anything derived from a catalog can tell when it has been replaced.
+
+    A catalog built as an update of a previous one reuses that catalog's
+    index entries for every unchanged song, and keeps the change log
+    (see c2v.get_changes) between the two in self.changes.
+    """
+    def __init__(self, songs, merged_dict, version, etag = None, last_modified = None,
+                    previous = None, changes = None):
+        self.songs = tuple(songs)
+        self.merged_dict = merged_dict
+        self.version = version
+        self.etag = etag
+        self.last_modified = last_modified
+        self.changes = changes or {'added': [], 'removed': [], 'changed': {}}
+
+        # song key -> Song
+        self.by_key = {song.key: song for song in self.songs}
+
+        with metrics.span('index'):
+            self.index = search.SearchIndex(self.songs, search.load_aliases(),
+                                            previous.index if previous is not None else None)
+            self.levels = search.LevelIndex(self.songs)
+
+            if previous is None:
+                self.prefixes = search.PrefixIndex(self.songs)
+            else:
+                old, new = set(previous.songs), set(self.songs)
+                self.prefixes = previous.prefixes.updated(old - new, new - old)
+
+    def __len__(self):
+        return len(self.songs)
+
+#################################################
+
+def build_catalog(content, etag = None, last_modified = None, previous = None):
+    """
+    Runs the whole scraping/preprocessing pipeline on an already downloaded
+    chartlist page. Given the catalog it replaces, only songs that were 
+    added or changed since are processed again.
+
+    :param content: HTML of the ct2viewer chartlist page
+    :param etag: ETag header the page was served with, if any
+    :param last_modified: Last-Modified header the page was served with, if any
+    :param previous: Catalog currently in use, if any
+    :return: Catalog object
+    """
+
+    if isinstance(content, str):
+        content = content.encode("UTF-8")
+
+    version = hashlib.sha1(content).hexdigest()
+
+    with metrics.span('parse'):
+        charts_df, merged_dict = c2v.parse_chartlist(content)
+
+    with metrics.span('romanize'):
+        romanizations = c2v.load_romanizations()
+        songs, changes = c2v.get_songs(charts_df, merged_dict, 
+                                        previous.songs if previous is not None else (), 
+                                        romanizations)
+        c2v.save_romanizations(romanizations)
+
+    return Catalog(songs, merged_dict, version, etag, last_modified, previous, changes)
+
+def fetch_catalog(source = utils.SOURCE, catalog = None):
+    """
+    Downloads the chartlist page and builds a new catalog from it.
+    If an existing catalog is given, the request is made conditional on its
+    validators so an unchanged page only costs a 304.
+
+    :param source: ct2viewer site link
+    :param catalog: Catalog to revalidate, if any
+    :return: New Catalog object, or None if the page has not changed
+    """
+
+    import requests
+
+    headers = {}
+
+    if catalog is not None:
+        if catalog.etag:
+            headers['If-None-Match'] = catalog.etag
+        if catalog.last_modified:
+            headers['If-Modified-Since'] = catalog.last_modified
+
+    with metrics.span('scrape'):
+        r = requests.get(source, headers = headers, timeout = 30)
+
+    if r.status_code == 304:
+        return None
+
+    r.raise_for_status()
+
+    # servers without validators still send the same page when nothing changed
+    if catalog is not None and hashlib.sha1(r.content).hexdigest() == catalog.version:
+        return None
+
+    return build_catalog(
+            r.content,
+            etag = r.headers.get('ETag'),
+            last_modified = r.headers.get('Last-Modified'),
+            previous = catalog
+        )
+
+def validate_catalog(catalog, previous = None):
+    """
+    Sanity checks a freshly built catalog before it replaces the one in use,
+    so a broken or partial page never gets served.
+
+    :param catalog: Newly built Catalog
+    :param previous: Catalog currently in use, if any
+    :raises ValueError: If the catalog looks broken
+    """
+
+    if len(catalog) == 0:
+        raise ValueError("Catalog is empty.")
+
+    if not all(song.song for song in catalog.songs):
+        raise ValueError("Catalog has songs without a title.")
+
+    if not all(song.links[2] for song in catalog.songs):
+        raise ValueError("Catalog has songs without a CHAOS link.")
+
+    if previous is not None and len(catalog) < len(previous) * utils.MIN_CATALOG_RATIO:
+        raise ValueError(f"Catalog shrank from {len(previous)} "
+                            f"to {len(catalog)} songs.")
+
+def log_changes(catalog, previous, path = utils.CHANGELOG_PATH):
+    """
+    Appends the changes between two catalogs to the change log, one JSON
+    object per line, and prints a summary.
+
+    :param catalog: Newly built Catalog
+    :param previous: Catalog it replaces
+    :param path: Location of the change log
+    """
+
+    changes = catalog.changes
+    entry = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'previous': previous.version,
+        'version': catalog.version,
+        **changes,
+    }
+
+    with open(path, 'a', encoding = 'utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii = False) + "\n")
+
+    print(f"Catalog updated: {len(changes['added'])} added, {len(changes['removed'])} removed, "
+            f"{len(changes['changed'])} changed.")
+
+#################################################
+
+def save_snapshot(catalog, path = utils.SNAPSHOT_PATH):
+    """
+    Writes the catalog to disk. The file is replaced atomically so a crash
+    mid-write never leaves a corrupt snapshot behind.
+
+    :param catalog: Catalog to save
+    :param path: Location of the snapshot file
+    """
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'songs': catalog.songs,
+        'merged_dict': catalog.merged_dict,
+        'catalog_version': catalog.version,
+        'etag': catalog.etag,
+        'last_modified': catalog.last_modified,
+    }
+
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, path)
+
+def load_snapshot(path = utils.SNAPSHOT_PATH):
+    """
+    Reads a catalog previously written by save_snapshot.
+
+    :param path: Location of the snapshot file
+    :return: Catalog object, or None if there is no usable snapshot
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+
+    return Catalog(
+            snapshot['songs'],
+            snapshot['merged_dict'],
+            snapshot['catalog_version'],
+            snapshot['etag'],
+            snapshot['last_modified']
+        )
+
+def load_catalog(path = utils.SNAPSHOT_PATH, source = utils.SOURCE):
+    """
+    Returns the local snapshot if there is one, otherwise scrapes the site
+    and saves the result for the next start.
+
+    :param path: Location of the snapshot file
+    :param source: ct2viewer site link
+    :return: Catalog object
+    """
+
+    catalog = load_snapshot(path)
+
+    if catalog is None:
+        catalog = fetch_catalog(source)
+        save_snapshot(catalog, path)
+
+    return catalog
+
+def revalidate(catalog, path = utils.SNAPSHOT_PATH, source = utils.SOURCE):
+    """
+    Checks the site for changes and updates the snapshot if there were any.
+    Blocking, so should be run in an executor when called from the bot.
+
+    :param catalog: Catalog currently in use
+    :param path: Location of the snapshot file
+    :param source: ct2viewer site link
+    :return: New Catalog object, or None if the page has not changed
+    :raises ValueError: If the new catalog fails validation
+    """
+
+    updated = fetch_catalog(source, catalog)
+
+    if updated is not None:
+        validate_catalog(updated, catalog)
+        save_snapshot(updated, path)
+        log_changes(updated, catalog)
+
+    return updated
+
+#################################################
+
+class CatalogRefresher:
+    """
+    Keeps the catalog in use up to date by periodically revalidating it in
+    a worker thread. A new catalog is only ever swapped in whole, by 
+    reassigning self.catalog, so commands that read the attribute once get
+    a consistent catalog, index and link map even across a refresh. 
+    Failures back off exponentially and keep the last good catalog.
+    """
+    def __init__(self, catalog, interval = utils.REFRESH_INTERVAL, 
+                    path = utils.SNAPSHOT_PATH, source = utils.SOURCE):
+        self.catalog = catalog
+        self.interval = interval
+        self.path = path
+        self.source = source
+        self.failures = 0
+
+    def get_delay(self):
+        """
+        :return: Seconds to wait until the next refresh
+        """
+
+        if self.failures == 0:
+            return self.interval
+
+        return min(self.interval, utils.REFRESH_RETRY * 2 ** (self.failures - 1))
+
+    async def refresh(self):
+        """
+        Revalidates the catalog once, off the event loop.
+        :return: New Catalog object if one was swapped in, otherwise None
+        """
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            updated = await loop.run_in_executor(
+                        None, revalidate, self.catalog, self.path, self.source)
+
+        except Exception as e:
+            self.failures += 1
+            print(f"Unable to refresh catalog, keeping current one: {e}")
+            return None
+
+        self.failures = 0
+
+        if updated is not None:
+            self.catalog = updated
+
+        return updated
+
+    async def run(self, on_update = None):
+        """
+        Refreshes the catalog forever, starting right away.
+        :param on_update: Coroutine function called with each new catalog
+        """
+
+        while True:
+            if (updated := await self.refresh()) is not None and on_update is not None:
+                # the new catalog is already in use, so a failing callback
+                # must not stop the refreshes that follow
+                try:
+                    await on_update(updated)
+
+                except Exception as e:
+                    print(f"Error handling updated catalog: {e}")
+
+            await asyncio.sleep(self.get_delay())
+
+#################################################
+
+if __name__ == "__main__":
+    # builds a fresh snapshot, e.g. from a local copy of the page with
+    # python catalog.py http://localhost:8000/chartlist.html
+    import sys
+
+    source = sys.argv[1] if len(sys.argv) > 1 else utils.SOURCE
+    save_snapshot(fetch_catalog(source))
@@ -0,0 +1,255 @@
+import aiohttp
+import asyncio
+import json
+import os
+import re
+import time
+
+import artwork
+import metrics
+import utils
+
+#################################################
+
+# note counts as chart pages show them, e.g. "Notes: 1024" or "1024 notes"
+NOTES_REGEXES = [
+    re.compile(r"notes?(?:\s*count)?\s*[:：]?\s*(\d+)", re.I),
+    re.compile(r"(\d+)\s*notes?\b", re.I),
+]
+
+# statuses worth asking again for, anything else fails the page right away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def parse_chart(content):
+    """
+    Reads the details the bot needs from the HTML of a chart page.
+    :param content: HTML of the chart page
+    :return: Tuple of (note count or None if the page has none, artwork link)
+    :raises ValueError: If the page can't be parsed, e.g. it came back empty
+    """
+
+    import lxml.etree
+    import lxml.html
+
+    if isinstance(content, bytes):
+        content = content.decode("UTF-8", errors = "replace")
+
+    try:
+        text = " ".join(lxml.html.fromstring(content).text_content().split())
+
+    except lxml.etree.LxmlError as e:
+        raise ValueError(f"Unreadable chart page: {e}")
+    notes = None
+
+    for regex in NOTES_REGEXES:
+        if (found := regex.search(text)) is not None:
+            notes = int(found.group(1))
+            break
+
+    return notes, artwork.parse_artwork(content)
+
+def get_difficulty(diff):
+    """
+    :param diff: Key of merged_dict, e.g. chaos.html
+    :return: Name of the difficulty, e.g. chaos
+    """
+    return diff.partition(".")[0]
+
+#################################################
+
+class ChartStore:
+    """
+    (song key, difficulty) -> (note count, artwork link) of every chart
+    crawled so far. Persisted as compact JSON, and doubles as the crawler's
+    progress: anything already stored is skipped by the next crawl.
+    """
+    def __init__(self, path = utils.CHART_STORE_PATH):
+        self.path = path
+        self.entries = {}
+
+    def __contains__(self, chart):
+        return chart in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, diff):
+        """
+        :param key: Song key
+        :param diff: Difficulty, e.g. chaos
+        :return: Tuple of (note count, artwork link), or None if not crawled
+        """
+        return self.entries.get((key, diff))
+
+    def put(self, key, diff, details):
+        self.entries[(key, diff)] = tuple(details)
+
+    def discard(self, key):
+        """
+        Forgets every chart of a song, so the next crawl fetches them again.
+        """
+        for diff in utils.LEVEL_COLUMNS:
+            self.entries.pop((key, diff), None)
+
+    def load(self):
+        try:
+            with open(self.path, encoding = 'utf-8') as f:
+                entries = json.load(f)
+
+        except (OSError, ValueError):
+            return
+
+        for key, charts in entries.items():
+            for diff, details in charts.items():
+                self.put(key, diff, details)
+
+    def save(self):
+        # nested by song so keys aren't repeated for every difficulty
+        entries = {}
+        for (key, diff), details in self.entries.items():
+            entries.setdefault(key, {})[diff] = details
+
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(entries, f, ensure_ascii = False, separators = (',', ':'))
+
+        os.replace(tmp_path, self.path)
+
+#################################################
+
+class ChartCrawler:
+    """
+    Fetches every chart page of a catalog into a ChartStore through a
+    bounded aiohttp connection pool. Requests are spaced out to at most
+    rate per second however many run at once, failed requests are retried
+    with exponential backoff, and the store is saved every few pages so an
+    interrupted crawl carries on where it stopped.
+    """
+    def __init__(self, store, concurrency = utils.CRAWL_CONCURRENCY, rate = utils.CRAWL_RATE,
+                    retries = utils.CRAWL_RETRIES, timeout = utils.HTTP_TIMEOUT,
+                    save_every = utils.CRAWL_SAVE_EVERY):
+        self.store = store
+        self.concurrency = concurrency
+        self.interval = 1 / rate
+        self.retries = retries
+        self.timeout = aiohttp.ClientTimeout(total = timeout)
+        self.save_every = save_every
+        self.next_request = 0
+        self.lock = asyncio.Lock()
+
+    async def wait_turn(self):
+        """
+        Sleeps until this request may start, keeping requests at least
+        self.interval seconds apart.
+        """
+
+        async with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + self.interval
+
+        await asyncio.sleep(start - now)
+
+    async def fetch(self, session, link):
+        """
+        :param session: aiohttp session to fetch with
+        :param link: Link to the chart page
+        :return: HTML of the page
+        :raises aiohttp.ClientError, asyncio.TimeoutError: If every attempt failed
+        """
+
+        for attempt in range(self.retries + 1):
+            await self.wait_turn()
+
+            try:
+                with metrics.span('crawl'):
+                    async with session.get(link) as r:
+                        if r.status in RETRY_STATUSES and attempt < self.retries:
+                            delay = r.headers.get('Retry-After', "")
+                            await asyncio.sleep(float(delay) if delay.isdigit() else 2 ** attempt)
+                            continue
+
+                        r.raise_for_status()
+                        return await r.read()
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+
+                await asyncio.sleep(2 ** attempt)
+
+    async def crawl(self, merged_dict, artwork_cache = None):
+        """
+        Crawls every chart not in the store yet.
+
+        :param merged_dict: Dictionary of links from parse_chartlist
+        :param artwork_cache: ArtworkCache to also fill from CHAOS pages,
+                              saving it is left to the caller
+        :return: Dictionary counting the charts fetched, skipped (already
+                 stored) and failed (unreachable or unreadable)
+        """
+
+        charts = [(key, get_difficulty(diff), link) for diff, links in merged_dict.items()
+                    for key, link in links.items()]
+        pending = [chart for chart in charts if chart[:2] not in self.store]
+        stats = {'fetched': 0, 'skipped': len(charts) - len(pending), 'failed': 0}
+
+        # artwork of CHAOS charts crawled before comes straight from the store
+        if artwork_cache is not None:
+            for key, diff, _ in charts:
+                if (diff == 'chaos' and key not in artwork_cache 
+                        and (details := self.store.get(key, diff)) is not None):
+                    artwork_cache.put(key, details[1])
+
+        queue = asyncio.Queue()
+        for chart in pending:
+            queue.put_nowait(chart)
+
+        async def work(session):
+            while not queue.empty():
+                key, diff, link = queue.get_nowait()
+
+                try:
+                    details = parse_chart(await self.fetch(session, link))
+
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    stats['failed'] += 1
+                    continue
+
+                self.store.put(key, diff, details)
+                stats['fetched'] += 1
+
+                if artwork_cache is not None and diff == 'chaos':
+                    artwork_cache.put(key, details[1])
+
+                if stats['fetched'] % self.save_every == 0:
+                    self.store.save()
+
+        connector = aiohttp.TCPConnector(limit = self.concurrency)
+
+        try:
+            async with aiohttp.ClientSession(timeout = self.timeout, connector = connector) as session:
+                await asyncio.gather(*(work(session) for _ in range(self.concurrency)))
+
+        finally:
+            # also when cancelled, so progress is never lost
+            self.store.save()
+
+        return stats
+
+#################################################
+
+if __name__ == "__main__":
+    # crawls every chart of the local snapshot, e.g. python crawler.py
+    # stop it at any point, running it again picks up where it left off
+    import catalog
+
+    store = ChartStore()
+    store.load()
+
+    data = catalog.load_catalog()
+    stats = asyncio.run(ChartCrawler(store).crawl(data.merged_dict))
+
+    print(f"{stats['fetched']} fetched, {stats['skipped']} already stored, "
+            f"{stats['failed']} failed, {len(store)} charts in {store.path}")
@@ -0,0 +1,157 @@
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+
+import asyncio
+import cache
+import catalog
+import utils
+
+#################################################
+
+class Busy(Exception):
+    """
+    Raised when too many searches are already waiting to run.
+    """
+
+# each worker process keeps its own read-only copy of the catalog, loaded
+# from the snapshot that the refresher writes before swapping catalogs
+worker_catalog = None
+
+def init_worker(path):
+    """
+    Warms up a new worker by loading the snapshot before any search arrives.
+    """
+    global worker_catalog
+
+    worker_catalog = catalog.load_snapshot(path)
+
+def load_worker_catalog(path, version):
+    """
+    Reloads the snapshot into the worker, unless the worker already has the
+    requested catalog version.
+
+    :param path: Location of the snapshot file
+    :param version: Catalog version the caller searched
+    :return: Catalog object
+    :raises LookupError: If the snapshot isn't of the requested version
+    """
+
+    global worker_catalog
+
+    if worker_catalog is None or worker_catalog.version != version:
+        worker_catalog = catalog.load_snapshot(path)
+
+    if worker_catalog is None or worker_catalog.version != version:
+        raise LookupError(f"Snapshot at {path} is not catalog version {version}.")
+
+    return worker_catalog
+
+def search_songs(path, version, query, limit):
+    return load_worker_catalog(path, version).index.search(query, limit)
+
+def search_many_songs(path, version, queries, limit):
+    return load_worker_catalog(path, version).index.search_many(queries, limit)
+
+def search_levels(path, version, low, high, difficulties, sort):
+    return load_worker_catalog(path, version).levels.search(low, high, difficulties, sort)
+
+#################################################
+
+class SearchExecutor:
+    """
+    Runs searches in a pool of worker processes so several can run at once
+    on multiple cores without stalling the event loop. Each command has its
+    own limit on concurrent searches, and new searches are refused with Busy
+    once too many are waiting. Identical searches of the same catalog made
+    while one is already running share its result instead of running again.
+    """
+    def __init__(self, workers = utils.SEARCH_WORKERS, max_pending = utils.SEARCH_MAX_PENDING,
+                    limits = utils.SEARCH_LIMITS, path = utils.SNAPSHOT_PATH):
+        self.path = path
+        self.max_pending = max_pending
+        self.pending = 0
+        self.flights = cache.SingleFlight()
+        self.semaphores = {command: asyncio.Semaphore(limit)
+                                for command, limit in limits.items()}
+        self.workers = workers
+        self.pool = self.make_pool()
+
+    def make_pool(self):
+        return ProcessPoolExecutor(
+                max_workers = self.workers,
+                initializer = init_worker,
+                initargs = (self.path,)
+            )
+
+    async def run(self, command, data, function, args, fallback):
+        """
+        Runs a search in the pool against the given catalog, or waits for
+        an identical one already running.
+
+        :param command: Name of the command, for its concurrency limit
+        :param data: Catalog to search
+        :param function: Module level function to run in a worker
+        :param args: Hashable arguments for function, after the path and version
+        :param fallback: Equivalent method of data, run in a thread if the
+                         worker can't load that catalog version or died
+        :return: Result of the search
+        :raises Busy: If too many searches are already waiting
+        """
+
+        return await self.flights.run((command, data.version, args),
+                    lambda: self.submit(command, data, function, args, fallback))
+
+    async def submit(self, command, data, function, args, fallback):
+        if self.pending >= self.max_pending:
+            raise Busy()
+
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+
+        try:
+            async with self.semaphores[command]:
+                pool = self.pool
+
+                try:
+                    return await loop.run_in_executor(
+                                pool, function, self.path, data.version, *args)
+
+                except LookupError:
+                    return await loop.run_in_executor(None, fallback, *args)
+
+                except BrokenExecutor:
+                    # a worker died (e.g. ran out of memory), which leaves the
+                    # pool unusable for good. The first search to notice
+                    # starts a fresh pool, and this one runs in a thread
+                    if self.pool is pool:
+                        pool.shutdown(wait = False)
+                        self.pool = self.make_pool()
+
+                    return await loop.run_in_executor(None, fallback, *args)
+
+        finally:
+            self.pending -= 1
+
+    async def search(self, data, query, limit = 10):
+        """
+        See SearchIndex.search
+        """
+        return await self.run('c2s', data, search_songs, (query, limit), data.index.search)
+
+    async def search_many(self, data, queries, limit = 10):
+        """
+        See SearchIndex.search_many
+        """
+        return await self.run('c2m', data, search_many_songs, (tuple(queries), limit), 
+                                data.index.search_many)
+
+    async def search_levels(self, data, low, high = None, difficulties = None, sort = None):
+        """
+        See LevelIndex.search
+        """
+        difficulties = tuple(difficulties) if difficulties else None
+
+        return await self.run('c2d', data, search_levels,
+                                (low, high, difficulties, sort), data.levels.search)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures = True)
@@ -0,0 +1,209 @@
+import bisect
+import importlib
+import os
+import sys
+import time
+import utils
+
+#################################################
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    """
+    Latencies of one stage, counted into BUCKETS.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        :param q: Quantile between 0 and 1
+        :return: Upper bound of the bucket the quantile falls in
+        """
+
+        target = q * self.count
+        seen = 0
+
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+
+        return float('inf')
+
+histograms = {}
+gauges = {}
+
+#################################################
+
+class Span:
+    """
+    Times the block it wraps and records it under the stage's name.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(name):
+    """
+    Usage: with metrics.span('search'): ...
+    When metrics are disabled this returns a shared no-op, so spans can stay
+    on hot paths.
+    """
+    return Span(name) if utils.METRICS_ENABLED else NULL_SPAN
+
+def observe(name, seconds):
+    if not utils.METRICS_ENABLED:
+        return
+
+    if name not in histograms:
+        histograms[name] = Histogram()
+
+    histograms[name].observe(seconds)
+
+def register_gauge(name, function):
+    """
+    :param name: Name of the gauge
+    :param function: Called with no arguments to read the gauge's value
+    """
+    gauges[name] = function
+
+class StartupProfile:
+    """
+    Times the imports and initialization steps of the bot while it starts.
+    Does nothing unless enabled, so it can stay in bot.py.
+    """
+    def __init__(self, enabled = utils.PROFILE_STARTUP):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.steps = []
+
+    def imports(self, names):
+        """
+        Imports modules one at a time, timing each. A module's time includes
+        any dependency not already imported by an earlier one.
+        :param names: Module names in the order to import them
+        """
+
+        for name in names:
+            with self.step(f"import {name}"):
+                importlib.import_module(name)
+
+    def step(self, name):
+        """
+        Usage: with startup.step('load catalog'): ...
+        """
+        return StartupStep(self, name) if self.enabled else NULL_SPAN
+
+    def report(self, label = "startup"):
+        """
+        Prints every step so far, the total since the profile started, and
+        which of utils.LAZY_MODULES have been imported.
+        """
+
+        if not self.enabled:
+            return
+
+        lines = [f"{'step':<32}{'ms':>10}"]
+        lines += [f"{name:<32}{seconds * 1000:>10.1f}" for name, seconds in self.steps]
+        lines.append(f"{label + ' total':<32}{(time.perf_counter() - self.start) * 1000:>10.1f}")
+
+        loaded = [name for name in utils.LAZY_MODULES if name in sys.modules]
+        lines.append(f"lazy modules loaded: {', '.join(loaded) or 'none'}")
+
+        print("\n".join(lines))
+
+class StartupStep:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.steps.append((self.name, time.perf_counter() - self.start))
+        return False
+
+#################################################
+
+def format_stats():
+    """
+    :return: Human readable summary of every histogram and gauge
+    """
+
+    lines = [f"{'stage':<24}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+
+    for name, histogram in sorted(histograms.items()):
+        mean = histogram.total / histogram.count * 1000 if histogram.count else 0
+        lines.append(f"{name:<24}{histogram.count:>8}{mean:>10.2f}"
+                        f"{histogram.quantile(0.5) * 1000:>10g}{histogram.quantile(0.99) * 1000:>10g}")
+
+    lines.append("")
+
+    for name, function in sorted(gauges.items()):
+        lines.append(f"{name:<24}{function():>8g}")
+
+    return "\n".join(lines)
+
+def format_prometheus():
+    """
+    :return: Every histogram and gauge in the Prometheus text format
+    """
+
+    lines = ["# TYPE argh_latency_seconds histogram"]
+
+    for name, histogram in sorted(histograms.items()):
+        seen = 0
+
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+            seen += count
+            lines.append(f'argh_latency_seconds_bucket{{stage="{name}",le="{bound}"}} {seen}')
+
+        lines.append(f'argh_latency_seconds_sum{{stage="{name}"}} {histogram.total}')
+        lines.append(f'argh_latency_seconds_count{{stage="{name}"}} {histogram.count}')
+
+    for name, function in sorted(gauges.items()):
+        lines.append(f"# TYPE argh_{name} gauge")
+        lines.append(f"argh_{name} {function()}")
+
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path = utils.METRICS_PATH):
+    """
+    Writes the metrics for node_exporter's textfile collector. Replaced
+    atomically so the collector never reads half a file.
+    """
+
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus())
+
+    os.replace(tmp_path, path)
@@ -1,44 +1,492 @@
-import pytesseract as tess
-import cv2
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from sessions import SharedSession
+
+import asyncio
+import copy
+import hashlib
+import metrics
+import time
+import numpy as np
+import re
+import executor
+import utils
 
 # TODO BW + high contrast will be the most reliable way to get the most readable text
 # TODO train model on Electrolize font
-# TODO split image into 4 parts - title / score / tp / judge breakdown
-# TODO compare song title against the list of songs scraped from ct2v 
 
-tess.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 config = "--psm 12 -l eng+chi_sim+chi_tra+jpn"
 
-#img = cv2.imread('c2ocrtest.png')
-#img = cv2.imread('c2nobgtest.png')
-img = cv2.imread('scores_without_share/c2phonetest.jpg', cv2.IMREAD_GRAYSCALE)
+# only the title can contain CJK text, the other regions are just digits 
+# (plus fixed labels) so they get a single language and a digit whitelist
+DIGITS = "-c tessedit_char_whitelist=0123456789"
+PROFILES = {
+    'title': config,
+    'title_latin': "--psm 7 -l eng",
+    'score': f"--psm 7 -l eng {DIGITS}",
+    'tp': f"--psm 7 -l eng {DIGITS}.",
+    'judge': f"--psm 6 -l eng {DIGITS}",
+}
 
-img = cv2.resize(img, (1920, 1080))
-#(thresh, img) = cv2.threshold(img, 128, 255, cv2.THRESH_BINARY)
+# regions read from the binarized image rather than the contrasted one
+THRESHOLDED = {'score', 'tp', 'judge'}
 
 alpha, beta = 1.2, 50
 
-img = cv2.convertScaleAbs(img, alpha = alpha, beta = beta)
+# crop boxes (start x, end x, start y, end y) measured on a 16:9 screenshot
+# of REFERENCE_SIZE, see get_crop_box for other sizes and aspect ratios
+REFERENCE_SIZE = (1920, 1080)
+REGIONS = {
+    'title': (480, 1450, 0, 150),
+    'score': (140, 630, 480, 600),
+    'tp': (860, 1060, 550, 650),
+    'judge': (625, 1115, 925, 1050),
+}
+
+# order the counts appear in the judgement breakdown
+JUDGEMENTS = ['perfect', 'good', 'bad', 'miss']
+
+# cv2 and pytesseract are imported on first use, so the bot can log in and
+# serve searches without loading them
+
+def get_tesseract():
+    """
+    :return: pytesseract, pointed at the configured tesseract binary
+    """
+    import pytesseract as tess
+
+    tess.pytesseract.tesseract_cmd = utils.TESSERACT_CMD
+
+    return tess
+
+#################################################
+
+def decode_image(data):
+    """
+    Decodes an encoded screenshot (PNG, JPG...) into a grayscale image.
+    :param data: Bytes of the image file
+    :return: Grayscale image as a NumPy array
+    :raises ValueError: If the data isn't an image
+    """
+
+    import cv2
+
+    img = cv2.imdecode(np.frombuffer(data, dtype = np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    if img is None:
+        raise ValueError("Unable to decode image.")
+
+    # crop boxes scale with the screenshot, so anything bigger than needed
+    # is shrunk straight away to keep the rest of the pipeline cheap
+    if (scale := utils.OCR_MAX_HEIGHT / min(img.shape[:2])) < 1:
+        img = cv2.resize(img, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+
+    return img
+
+def perceptual_hash(data):
+    """
+    Difference hash of a screenshot: each bit tells whether a pixel of a 
+    9x8 thumbnail is brighter than its right neighbour. Survives resizing
+    and recompression, unlike a hash of the file.
+    :param data: Bytes of the image file
+    :return: Hash as a 64 bit int
+    :raises ValueError: If the data isn't an image
+    """
+
+    import cv2
+
+    # JPEGs can be decoded straight at 1/8 size, which is all this needs
+    img = cv2.imdecode(np.frombuffer(data, dtype = np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+    if img is None:
+        raise ValueError("Unable to decode image.")
+
+    thumbnail = cv2.resize(img, (9, 8), interpolation = cv2.INTER_AREA)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def preprocess(img):
+    """
+    Raises the contrast of a grayscale screenshot (same as cv2.convertScaleAbs)
+    and binarizes it, both at the screenshot's own resolution.
+    :param img: Grayscale image
+    :return: Tuple of (contrasted image, thresholded image)
+    """
+
+    img = np.clip(np.rint(img * alpha + beta), 0, 255).astype(np.uint8)
+    thresholded = np.where(img >= utils.OCR_THRESHOLD, 255, 0).astype(np.uint8)
+
+    return img, thresholded
+
+def get_crop_box(region, shape):
+    """
+    Scales a region's reference crop box to a screenshot. The game keeps its
+    16:9 layout centered, so wider screenshots (most phones) are scaled by
+    height with the extra width split between both sides, and taller ones
+    (tablets) are scaled by width with the extra height split likewise.
+    :param region: Name of the region
+    :param shape: Shape of the screenshot
+    :return: Tuple of (start x, end x, start y, end y)
+    """
+
+    height, width = shape[:2]
+    ref_width, ref_height = REFERENCE_SIZE
+
+    scale = min(width / ref_width, height / ref_height)
+    offset_x = (width - ref_width * scale) / 2
+    offset_y = (height - ref_height * scale) / 2
+
+    start_x, end_x, start_y, end_y = REGIONS[region]
+
+    return (round(start_x * scale + offset_x), round(end_x * scale + offset_x),
+            round(start_y * scale + offset_y), round(end_y * scale + offset_y))
+
+def crop_regions(images):
+    """
+    Splits a processed screenshot into the 4 parts that are read:
+    title / score / tp / judge breakdown.
+    :param images: Output of preprocess
+    :return: Dictionary in the format {<region> : <image>}
+    """
+
+    img, thresholded = images
+    crops = {}
+
+    for region in REGIONS:
+        start_x, end_x, start_y, end_y = get_crop_box(region, img.shape)
+        source = thresholded if region in THRESHOLDED else img
+        crops[region] = source[start_y:end_y, start_x:end_x]
+
+    return crops
+
+def read_text(img, region, timeout = utils.OCR_TIMEOUT):
+    """
+    :param img: Image of a single region
+    :param region: Name of the region, to pick its recognition profile
+    :param timeout: Seconds before tesseract is killed
+    :return: Text tesseract found in the region
+    :raises asyncio.TimeoutError: If tesseract took longer than the timeout
+    """
+
+    # pytesseract treats a timeout of 0 as none at all
+    if timeout <= 0:
+        raise asyncio.TimeoutError("Ran out of time reading the screenshot.")
+
+    try:
+        return get_tesseract().image_to_string(img, config = PROFILES[region], 
+                                        timeout = timeout).strip()
+
+    except RuntimeError as e:
+        # pytesseract's way of saying it killed tesseract, other errors
+        # (TesseractError is a RuntimeError too) are left as they are
+        if str(e) != "Tesseract process timeout":
+            raise
+
+        raise asyncio.TimeoutError("Ran out of time reading the screenshot.")
+
+#################################################
+
+def parse_score(text):
+    """
+    :param text: OCR output of the score region, e.g. "1 000 000"
+    :return: Score as an int, or None if there are no digits
+    """
+
+    digits = re.sub(r"\D", "", text)
+
+    return int(digits) if digits else None
+
+def parse_tp(text):
+    """
+    :param text: OCR output of the TP region, e.g. "TP 99.87"
+    :return: TP as a float, or None if no number was found
+    """
+
+    numbers = re.findall(r"\d+(?:[.,]\d+)?", text)
+
+    return float(numbers[0].replace(",", ".")) if numbers else None
+
+def parse_judgements(text):
+    """
+    :param text: OCR output of the judgement breakdown region
+    :return: Dictionary in the format {<judgement> : <count>}, with None
+             for counts that could not be read
+    """
+
+    counts = [int(number) for number in re.findall(r"\d+", text)]
+    counts += [None] * (len(JUDGEMENTS) - len(counts))
+
+    return dict(zip(JUDGEMENTS, counts))
+
+def process_image(data, timeout = utils.OCR_TIMEOUT):
+    """
+    Reads the result of a play from a screenshot. The title only gets the
+    cheap Latin-only pass here, see read_title for the full one.
+    :param data: Bytes of the image file
+    :param timeout: Seconds the whole screenshot may take
+    :return: Dictionary with the song's title, score, TP and judgements,
+             the title's crop in case it has to be read again, and how long
+             each stage took
+    :raises asyncio.TimeoutError: If reading took longer than the timeout
+    """
+
+    # runs in a worker process, so timings are handed back to be recorded
+    timings = {}
+    start = time.perf_counter()
+    deadline = start + timeout
+
+    regions = crop_regions(preprocess(decode_image(data)))
+    timings['ocr_preprocess'] = time.perf_counter() - start
+
+    text = {}
+    passes = [('title', 'title_latin'), ('score', 'score'), ('tp', 'tp'), ('judge', 'judge')]
+
+    for i, (region, profile) in enumerate(passes):
+        start = time.perf_counter()
 
-#cv2.imwrite('test.jpg', img)
+        # what's left of the budget is split between the regions left, so
+        # a region finishing early leaves more time for the ones after it
+        text[region] = read_text(regions[region], profile, 
+                                    (deadline - start) / (len(passes) - i))
+        timings[f"ocr_{region}"] = time.perf_counter() - start
 
-TITLE_START_X, TITLE_END_X, TITLE_START_Y, TITLE_END_Y = 480, 1450, 0, 150
-SCORE_START_X, SCORE_END_X, SCORE_START_Y, SCORE_END_Y = 140, 630, 480, 600
-TP_START_X, TP_END_X, TP_START_Y, TP_END_Y = 860, 1060, 550, 650
-JUDGE_START_X, JUDGE_END_X, JUDGE_START_Y, JUDGE_END_Y = 625, 1115, 925, 1050
+    return {
+        'title': text['title'],
+        'score': parse_score(text['score']),
+        'tp': parse_tp(text['tp']),
+        'judgements': parse_judgements(text['judge']),
+        'title_crop': regions['title'].copy(),
+        'timings': timings,
+    }
 
-title = img[TITLE_START_Y: TITLE_END_Y, TITLE_START_X:TITLE_END_X].copy()
-score = img[SCORE_START_Y: SCORE_END_Y, SCORE_START_X:SCORE_END_X].copy()
-tp = img[TP_START_Y: TP_END_Y, TP_START_X:TP_END_X].copy()
-judge = img[JUDGE_START_Y: JUDGE_END_Y, JUDGE_START_X:JUDGE_END_X].copy()
+def read_title(img, timeout = utils.OCR_TIMEOUT):
+    """
+    Multilingual pass over the title, for titles the Latin-only pass
+    couldn't match to a song.
+    :param img: Crop of the title region
+    :param timeout: Seconds before tesseract is killed
+    :return: Text tesseract found in the region
+    """
+
+    return read_text(img, 'title', timeout)
+
+def identify_title(result, data):
+    """
+    Matches the title read from a screenshot against the catalog.
+    :param result: Output of process_image, updated in place
+    :param data: Catalog to match against
+    :return: Score of the match, 0 if there was none
+    """
+
+    match = data.index.identify(result['title'])
+
+    if match is None or match.score < utils.TITLE_MIN_SCORE:
+        result['key'] = result['song'] = None
+        return 0
+
+    song = data.songs[match.row]
+    result['key'] = song.key
+    result['song'] = song.song
+
+    return match.score
+
+#################################################
+
+class ScreenshotIntake:
+    """
+    Downloads screenshots attached to messages straight into memory through
+    a shared aiohttp connection pool. Nothing is written to disk, and a 
+    download is abandoned as soon as it grows past the size cap.
+    """
+    def __init__(self, max_size = utils.SCREENSHOT_MAX_BYTES, session = None):
+        self.max_size = max_size
+        self.session = session or SharedSession()
+
+    async def read(self, url):
+        """
+        :param url: Link to the screenshot
+        :return: Bytes of the image file
+        :raises ValueError: If the file is bigger than the size cap
+        :raises aiohttp.ClientError: If the download failed
+        """
+
+        async with self.session.get().get(url) as r:
+            r.raise_for_status()
+
+            if (r.content_length or 0) > self.max_size:
+                raise ValueError("Screenshot is too large.")
+
+            buffer = bytearray()
+
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                buffer += chunk
+
+                if len(buffer) > self.max_size:
+                    raise ValueError("Screenshot is too large.")
+
+        return bytes(buffer)
+
+#################################################
+
+def init_worker():
+    """
+    Makes sure each worker can reach tesseract before any job arrives.
+    """
+    get_tesseract().get_tesseract_version()
+
+class Unavailable(Exception):
+    """
+    Raised when the OCR workers died, usually because tesseract is missing
+    or broken.
+    """
+
+class OCREngine:
+    """
+    Runs screenshot OCR in a pool of worker processes so the bot is never
+    blocked by it. Jobs that take too long are abandoned, and new jobs are
+    refused with executor.Busy once too many are waiting, counting jobs
+    abandoned but still running in a worker. Screenshots seen before are
+    answered from the cache without running any OCR.
+    """
+    def __init__(self, workers = utils.OCR_WORKERS, max_pending = utils.OCR_MAX_PENDING,
+                    timeout = utils.OCR_TIMEOUT, cache = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.cache = cache
+        self.pending = 0
+        self.abandoned = 0
+        self.pool = self.make_pool()
+
+    def make_pool(self):
+        return ProcessPoolExecutor(max_workers = self.workers, initializer = init_worker)
+
+    def release(self, future):
+        """
+        Frees the slot of an abandoned job once its worker is done with it.
+        """
+        self.abandoned -= 1
+
+        if not future.cancelled():
+            future.exception()
+
+    async def submit(self, function, *args):
+        """
+        Runs function(*args, self.timeout) in the pool.
+        :raises asyncio.TimeoutError: If the job took longer than the timeout
+        :raises Unavailable: If the pool's workers died
+        """
+
+        loop = asyncio.get_running_loop()
+
+        # the job is told its timeout too and stops on its own by then, the
+        # wait_for only guards against it hanging anywhere else
+        future = loop.run_in_executor(self.pool, function, *args, self.timeout)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout = self.timeout + 1)
+
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # the worker keeps running the job until it finishes, so its
+            # slot is only given back then
+            self.abandoned += 1
+            future.add_done_callback(self.release)
+            raise
+
+        except BrokenExecutor:
+            # a dead pool stays dead, so a fresh one is started for the next
+            # job. If tesseract is missing that one dies again right away
+            self.pool.shutdown(wait = False)
+            self.pool = self.make_pool()
+            raise Unavailable("OCR is unavailable at the moment.")
+
+    async def process(self, data, catalog = None):
+        """
+        Reads a screenshot, see process_image. If a catalog is given the
+        title is looked up in it, and the slow multilingual pass over the 
+        title only runs when the Latin-only pass didn't match a song well.
+        :param data: Bytes of the image file
+        :param catalog: Catalog to identify the song with
+        :return: Dictionary with the song's title, score, TP, judgements and,
+                 if a catalog was given, its key and title in the catalog
+        :raises executor.Busy: If too many jobs are already waiting
+        :raises asyncio.TimeoutError: If a job took longer than the timeout
+        :raises Unavailable: If tesseract can't be run
+        """
+
+        if self.pending + self.abandoned >= self.max_pending:
+            raise executor.Busy()
+
+        self.pending += 1
+
+        try:
+            if self.cache is None:
+                return await self.read_screenshot(data, catalog)
+
+            digest = hashlib.sha256(data).hexdigest()
+
+            if digest in self.cache:
+                return copy.deepcopy(self.cache.get(digest))
+
+            # cv2 releases the GIL, so hashing in a thread doesn't block the loop
+            loop = asyncio.get_running_loop()
+            phash = await loop.run_in_executor(None, perceptual_hash, data)
+
+            result = await self.read_screenshot(data, catalog, self.cache.get_similar(phash))
+            self.cache.put(digest, phash, result)
+
+            return copy.deepcopy(result)
+
+        finally:
+            self.pending -= 1
+
+    async def read_screenshot(self, data, catalog, similar = None):
+        """
+        The actual OCR behind process, without any caching.
+        :param similar: Cached result of a screenshot that looks almost the
+                        same, whose song is taken instead of identifying it
+                        again. The score, TP and judgements are always read.
+        """
+        result = await self.submit(process_image, data)
+        title_crop = result.pop('title_crop')
+
+        for stage, seconds in result.pop('timings').items():
+            metrics.observe(stage, seconds)
+
+        if similar is not None:
+            result.update({field: similar[field] for field in ('title', 'key', 'song') 
+                                if field in similar})
+            return result
+
+        latin_score = identify_title(result, catalog) if catalog is not None else 0
+
+        if latin_score >= utils.TITLE_MATCH_SCORE:
+            return result
+
+        latin_result = dict(result)
+        with metrics.span('ocr_title_multilingual'):
+            result['title'] = await self.submit(read_title, title_crop)
+
+        # keep whichever pass matched the catalog better
+        if catalog is not None and identify_title(result, catalog) < latin_score:
+            return latin_result
+
+        return result
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures = True)
+
+#################################################
 
 def show_output(img, gray = False):
+    import cv2
+
     if gray:
         height, width = img.shape
     else:
         height, width, _ = img.shape
 
-    data = tess.image_to_data(img, config = config)
+    data = get_tesseract().image_to_data(img, config = config)
 
     for i, line in enumerate(data.splitlines()):
         if i != 0:
@@ -53,4 +501,12 @@ def show_output(img, gray = False):
     cv2.imshow('Result with blocks', img)
     cv2.waitKey(0)
 
-show_output(judge, gray = True)
\ No newline at end of file
+if __name__ == "__main__":
+    # e.g. python ocr.py scores_without_share/c2phonetest.jpg
+    import sys
+
+    with open(sys.argv[1], 'rb') as f:
+        data = f.read()
+
+    print(process_image(data))
+    show_output(crop_regions(preprocess(decode_image(data)))['judge'].copy(), gray = True)
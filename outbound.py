@@ -0,0 +1,132 @@
+from collections import OrderedDict, defaultdict, deque
+
+import asyncio
+import time
+import utils
+
+#################################################
+
+class SendQueue:
+    """
+    Paces everything the bot sends so no channel gets more than rate
+    messages (or edits, or reactions) per period. Commands share the queue, so a burst
+    from one waits its turn in order instead of running into Discord's rate
+    limit and holding up every other command in the channel.
+    """
+    def __init__(self, rate = utils.SEND_RATE, period = utils.SEND_PERIOD):
+        self.rate = rate
+        self.period = period
+        self.sent = defaultdict(deque)
+        self.locks = defaultdict(asyncio.Lock)
+        self.waiting = 0
+
+    async def wait_turn(self, channel):
+        """
+        Sleeps until another message may go to the channel.
+        :param channel: Channel about to be sent to
+        """
+
+        self.waiting += 1
+
+        try:
+            # held while sleeping, so messages to a channel leave in order
+            async with self.locks[channel.id]:
+                sent = self.sent[channel.id]
+
+                while sent and time.monotonic() - sent[0] >= self.period:
+                    sent.popleft()
+
+                if len(sent) >= self.rate:
+                    await asyncio.sleep(self.period - (time.monotonic() - sent.popleft()))
+
+                sent.append(time.monotonic())
+
+        finally:
+            self.waiting -= 1
+
+    async def send(self, channel, *args, **kwargs):
+        """
+        Same as channel.send, once it's the message's turn.
+        """
+        await self.wait_turn(channel)
+
+        return await channel.send(*args, **kwargs)
+
+    async def edit(self, message, **kwargs):
+        """
+        Same as message.edit, once it's the edit's turn.
+        """
+        await self.wait_turn(message.channel)
+
+        return await message.edit(**kwargs)
+
+    async def add_reaction(self, message, emoji):
+        """
+        Same as message.add_reaction, once it's the reaction's turn.
+        """
+        await self.wait_turn(message.channel)
+
+        return await message.add_reaction(emoji)
+
+    async def remove_reaction(self, reaction, user):
+        """
+        Same as reaction.remove, once it's the removal's turn.
+        """
+        await self.wait_turn(reaction.message.channel)
+
+        return await reaction.remove(user)
+
+#################################################
+
+class PageCache:
+    """
+    Message id -> pages of a paged message and the page it shows, so
+    turning a page only edits the message rather than running the command
+    again. The least recently used messages are dropped once full, and
+    messages stop turning after ttl seconds.
+    """
+    def __init__(self, max_size = utils.PAGE_CACHE_SIZE, ttl = utils.PAGE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, message_id, pages):
+        """
+        :param message_id: Id of the message showing the first page
+        :param pages: List of discord.Embed objects
+        """
+
+        self.entries[message_id] = [pages, 0, time.monotonic()]
+        self.entries.move_to_end(message_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def turn(self, message_id, step):
+        """
+        :param message_id: Id of the paged message
+        :param step: Pages to move by, e.g. -1 for the previous page
+        :return: Embed of the page to show, or None if the message isn't
+                 paged (anymore) or is already on its first/last page
+        """
+
+        if (entry := self.entries.get(message_id)) is None:
+            return None
+
+        pages, current, created = entry
+
+        if time.monotonic() - created > self.ttl:
+            del self.entries[message_id]
+            return None
+
+        self.entries.move_to_end(message_id)
+
+        if not 0 <= current + step < len(pages):
+            return None
+
+        entry[1] = current + step
+
+        return pages[current + step]
@@ -0,0 +1,565 @@
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+from collections import defaultdict, namedtuple
+
+import bisect
+import json
+import re
+import numpy as np
+import utils
+
+#################################################
+
+# length of the n-grams used for candidate generation
+NGRAM_SIZE = 3
+
+# buckets characters are counted into to bound scores, one per ASCII
+# character and the rest shared by everything else (e.g. kana and kanji)
+CHAR_BUCKETS = 256
+
+# row: position of the song in the catalog, score: fuzz ratio 0-100
+Match = namedtuple('Match', ['row', 'score'])
+
+#################################################
+
+def normalize(text):
+    """
+    Same processing fuzzywuzzy applies before scoring: characters from
+    U+0080 to U+00FF (accented Latin letters and such) are dropped, anything
+    that isn't a letter or digit becomes whitespace, and the result is
+    lowercased. Japanese/Chinese text is kept as is.
+
+    :param text: String to normalize
+    :return: Normalized string
+    """
+
+    if not isinstance(text, str):
+        return ""
+
+    return fuzz_utils.full_process(text, force_ascii = True)
+
+def get_ngrams(text):
+    """
+    Splits a normalized string into the n-grams of each of its tokens,
+    padded with spaces so short tokens still produce one.
+
+    :param text: Normalized string
+    :return: Set of n-grams
+    """
+
+    ngrams = set()
+
+    for token in text.split():
+        token = f" {token} "
+        ngrams.update(token[i : i + NGRAM_SIZE]
+                        for i in range(max(1, len(token) - NGRAM_SIZE + 1)))
+
+    return ngrams
+
+def get_char_counts(text):
+    """
+    Counts the characters token_set_ratio compares a string by when it has
+    no token in common with the other one: its distinct tokens, sorted and
+    joined by spaces. ASCII characters get a bucket each, any other
+    character is counted in a bucket shared with others. Two strings never
+    have more characters in common than their counts do, so bounds worked
+    out from the counts stay upper bounds.
+
+    :param text: Normalized string
+    :return: NumPy array of counts, CHAR_BUCKETS long
+    """
+
+    joined = " ".join(sorted(set(text.split())))
+    codes = np.frombuffer(joined.encode('utf-32-le'), dtype = np.uint32)
+    buckets = np.where(codes < 128, codes, 128 + codes % (CHAR_BUCKETS - 128))
+
+    return np.bincount(buckets, minlength = CHAR_BUCKETS).astype(np.int16)
+
+def get_exact_keys(text):
+    """
+    Forms a query naming text exactly can arrive in: as typed (see 
+    utils.normalize_query) or with punctuation dropped as fuzzy search does.
+
+    :param text: Title, romanization, key or alias
+    :return: Set of lookup keys
+    """
+
+    if not isinstance(text, str):
+        return set()
+
+    return {utils.normalize_query(text), " ".join(normalize(text).split())} - {""}
+
+def load_aliases(path = utils.ALIAS_PATH):
+    """
+    :param path: Location of the alias table
+    :return: Dictionary in the format {<alias> : <song title or key>}
+    """
+
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+#################################################
+
+def get_features(song):
+    """
+    Everything SearchIndex derives from a single song. Kept per song, so an
+    updated catalog only derives it again for the songs that changed.
+
+    :param song: Song object
+    :return: Dictionary of the normalized title, romanized title and artist,
+             compact title, n-grams, and the exact lookup keys of each layer
+    """
+
+    title = normalize(song.song)
+    key_j = normalize(song.key_j)
+
+    return {
+        'title': title,
+        'key_j': key_j,
+        'artist': normalize(song.artist),
+        'compact': "".join(song.song.casefold().split()),
+        'ngrams': get_ngrams(title) | get_ngrams(key_j),
+        'counts': (get_char_counts(title), get_char_counts(key_j)),
+        'exact': [
+            get_exact_keys(song.song),
+            get_exact_keys(f"{song.song} ({song.artist})"),
+            set().union(*(get_exact_keys(text) 
+                            for text in (song.key_j, song.hiragana, song.katakana))),
+            get_exact_keys(song.key) | get_exact_keys(song.key.replace(" ", "_")),
+        ],
+    }
+
+class SearchIndex:
+    """
+    Precomputed lookup structures over the catalog, built once per catalog
+    load so searching doesn't have to walk every song. Given the index of
+    the catalog being replaced, only new or changed songs are processed
+    again.
+    """
+    def __init__(self, songs, aliases = None, previous = None):
+        known = previous.features if previous is not None else {}
+        features = [known.get(song) or get_features(song) for song in songs]
+        self.features = dict(zip(songs, features))
+
+        self.songs = [song.song for song in songs]
+        self.titles = [feature['title'] for feature in features]
+        self.keys_j = [feature['key_j'] for feature in features]
+        self.artists = [feature['artist'] for feature in features]
+
+        # casefolded titles without any whitespace, for matching OCR output
+        # which keeps non-ASCII text but often splits or joins words
+        self.compact_titles = [feature['compact'] for feature in features]
+
+        # character counts of the titles and romanized titles, to bound the
+        # score of rows the n-grams didn't pick
+        self.title_counts = np.array([feature['counts'][0] for feature in features],
+                                        dtype = np.int16).reshape(len(features), CHAR_BUCKETS)
+        self.key_j_counts = np.array([feature['counts'][1] for feature in features],
+                                        dtype = np.int16).reshape(len(features), CHAR_BUCKETS)
+
+        # lookup key -> row of the only song it names. Earlier layers win,
+        # and a key naming several songs in one layer (e.g. the title of 
+        # songs told apart by artist) is left to the fuzzy search instead.
+        # layers: title, title (artist), readings, site key
+        self.exact = {}
+        blocked = set()
+
+        for layer in range(len(features[0]['exact']) if features else 0):
+            self.add_exact([(feature['exact'][layer], row) 
+                                for row, feature in enumerate(features)], blocked)
+
+        # aliases name their song by title or key, through the layers above
+        if aliases:
+            self.add_exact([(get_exact_keys(alias), row) for alias, target in aliases.items()
+                                if (row := self.lookup(target)) is not None], blocked)
+
+        # n-gram -> rows whose title or romanized title contain it
+        postings = defaultdict(list)
+        for row, feature in enumerate(features):
+            for ngram in feature['ngrams']:
+                postings[ngram].append(row)
+
+        self.postings = {ngram: np.array(rows, dtype = np.int32)
+                            for ngram, rows in postings.items()}
+
+    def __len__(self):
+        return len(self.songs)
+
+    def add_exact(self, entries, blocked):
+        """
+        Adds a layer of exact lookups, skipping keys already taken.
+
+        :param entries: List of (set of lookup keys, row) pairs
+        :param blocked: Set of keys known to name several songs, updated
+                        in place
+        """
+
+        # key -> its row, or None once a second row has it too
+        rows = {}
+
+        for keys, row in entries:
+            for key in keys:
+                if rows.setdefault(key, row) != row:
+                    rows[key] = None
+
+        for key, row in rows.items():
+            if key in self.exact or key in blocked:
+                continue
+
+            if row is None:
+                blocked.add(key)
+            else:
+                self.exact[key] = row
+
+    def lookup(self, query):
+        """
+        :param query: A query in string format
+        :return: Row of the song the query names exactly, or None
+        """
+
+        for key in get_exact_keys(query):
+            if (row := self.exact.get(key)) is not None:
+                return row
+
+        return None
+
+    def get_candidates(self, query):
+        """
+        Rows sharing at least one n-gram with the normalized query.
+
+        :param query: Normalized query
+        :return: NumPy array of rows
+        """
+
+        postings = [self.postings[ngram] for ngram in get_ngrams(query)
+                        if ngram in self.postings]
+
+        if not postings:
+            return np.empty(0, dtype = np.int32)
+
+        return np.unique(np.concatenate(postings))
+
+    def get_bounds(self, query, is_japanese):
+        """
+        The highest score each row could get if it shares no token with the
+        query, which holds for every row outside get_candidates: without a
+        token in common token_set_ratio is the ratio of the two sorted token
+        strings, and a ratio is at most twice the characters the strings
+        have in common over their total length.
+
+        :param query: Normalized query
+        :param is_japanese: Whether the raw query contained Japanese
+        :return: NumPy array of upper bounds, one per row
+        """
+
+        counts = get_char_counts(query)
+        bounds = np.zeros(len(self))
+
+        for matrix in (self.title_counts,) if is_japanese else (self.title_counts, self.key_j_counts):
+            common = np.minimum(matrix, counts).sum(axis = 1)
+            total = matrix.sum(axis = 1) + counts.sum()
+            bounds = np.maximum(bounds, 200 * common / np.maximum(total, 1))
+
+        return np.ceil(bounds)
+
+    def score(self, rows, query, is_japanese):
+        """
+        Scores a batch of rows against the query. Each row gets the best of
+        its title and (for non-Japanese queries) romanized title ratios.
+
+        :param rows: NumPy array of rows to score
+        :param query: Normalized query
+        :param is_japanese: Whether the raw query contained Japanese
+        :return: NumPy array of scores, aligned with rows
+        """
+
+        scores = np.fromiter(
+                    (fuzz.token_set_ratio(self.titles[row], query, full_process = False)
+                        for row in rows),
+                    dtype = np.int16, count = len(rows)
+                )
+
+        if not is_japanese:
+            scores_j = np.fromiter(
+                    (fuzz.token_set_ratio(self.keys_j[row], query, full_process = False)
+                        for row in rows),
+                    dtype = np.int16, count = len(rows)
+                )
+            scores = np.maximum(scores, scores_j)
+
+        return scores
+
+    def search(self, query, limit = 10):
+        """
+        Fetches the closest matching songs from the catalog.
+
+        :param query: A query in string format, usually the name of a song
+        :param limit: Maximum number of matches to return, not counting 
+                      matches tied for the best score, which are all returned
+        :return: List of Match tuples ranked by score, best first. An exact
+                 (case-insensitive) title match is returned on its own.
+        """
+
+        # if the query names a song exactly simply return it, most real
+        # queries stop here and never reach the scorer
+        if (row := self.lookup(query)) is not None:
+            return [Match(row, 100)]
+
+        normalized = normalize(query)
+
+        # nothing left to compare after normalizing, every ratio would be 0
+        if not normalized:
+            return []
+
+        # check if input is japanese
+        is_japanese = re.search(utils.JP_REGEX, query) is not None
+
+        rows = self.get_candidates(normalized)
+        scores = self.score(rows, normalized, is_japanese)
+
+        # the rows left out are only scored if they could reach the best
+        # candidate, so the best score and every row tied for it are always
+        # the same as scoring every row. Lower ranks may miss rows that
+        # could only have placed there.
+        best = int(scores.max()) if len(scores) else 1
+        others = np.setdiff1d(np.flatnonzero(self.get_bounds(normalized, is_japanese) >= best),
+                                rows, assume_unique = True)
+
+        if len(others):
+            rows = np.concatenate([rows, others])
+            scores = np.concatenate([scores, self.score(others, normalized, is_japanese)])
+
+        # catalog order between equal scores
+        order = np.lexsort((rows, -scores))
+        ranks = np.arange(len(order))
+        order = order[(ranks < limit) | (scores[order] == scores[order[0]])] if len(order) else order
+
+        return [Match(int(rows[i]), int(scores[i])) for i in order if scores[i] > 0]
+
+    def search_many(self, queries, limit = 10):
+        """
+        Same as search for every query of a batch, so a batch costs a single
+        trip to a worker. Repeated queries are only searched once.
+
+        :param queries: List of queries in string format
+        :param limit: Maximum number of matches to return per query
+        :return: List of lists of Match tuples, aligned with queries
+        """
+
+        results = {query: self.search(query, limit) for query in dict.fromkeys(queries)}
+
+        return [results[query] for query in queries]
+
+    def identify(self, text):
+        """
+        Finds which song an OCR'd title belongs to. Latin text goes through
+        the normal search (so romanized titles match too), Japanese/Chinese
+        text is compared character by character against the titles as is.
+
+        :param text: Title read from a screenshot
+        :return: Match of the most likely song, or None if nothing matched
+        """
+
+        if re.search(utils.JP_REGEX, text):
+            text = "".join(text.casefold().split())
+            scores = np.fromiter((fuzz.ratio(text, title) for title in self.compact_titles),
+                                    dtype = np.int16, count = len(self))
+            row = int(scores.argmax()) if len(scores) else 0
+
+            return Match(row, int(scores[row])) if len(scores) and scores[row] > 0 else None
+
+        matches = self.search(text, limit = 1)
+
+        return matches[0] if matches else None
+
+#################################################
+
+def get_prefixes(song):
+    """
+    Everything a song can be completed from: its title, romanized title and
+    kana readings, artist and site key, each both as typed (casefolded, 
+    keeping Japanese) and as normalized for fuzzy search.
+
+    :param song: Song object
+    :return: Tuple of (set of whole strings, set of strings starting at each
+             later word of the title, romanized title or artist)
+    """
+
+    whole = set()
+    words = set()
+
+    by_word = (song.song, song.key_j, song.artist)
+
+    for text in by_word + (song.hiragana, song.katakana, song.key):
+        for form in {utils.normalize_query(text or ""), " ".join(normalize(text).split())}:
+            if not form:
+                continue
+
+            whole.add(form)
+
+            if text in by_word:
+                tokens = form.split()
+                words.update(" ".join(tokens[i:]) for i in range(1, len(tokens)))
+
+    return whole, words
+
+class PrefixIndex:
+    """
+    Sorted (text, title) entries for completing partial queries with a
+    binary search, fast enough to answer on every keystroke. Entries for
+    whole strings are kept apart from those starting at a later word, so 
+    "chr" offers Chrome VOX before anything merely containing a word "chr...".
+
+    Completions are titles rather than keys, as titles are unique once
+    duplicates are handled and can be searched for exactly as they are.
+    """
+    def __init__(self, songs):
+        self.whole = []
+        self.words = []
+
+        for song in songs:
+            whole, words = get_prefixes(song)
+            self.whole.extend((text, song.song) for text in whole)
+            self.words.extend((text, song.song) for text in words)
+
+        self.whole.sort()
+        self.words.sort()
+
+    def updated(self, removed, added):
+        """
+        :param removed: Songs no longer in the catalog (or changed)
+        :param added: Songs new to the catalog (or changed)
+        :return: Copy of the index with the changes applied, leaving this
+                 one as it is for the catalog still using it
+        """
+
+        index = PrefixIndex(())
+        index.whole = list(self.whole)
+        index.words = list(self.words)
+
+        for song in removed:
+            index.remove(song)
+
+        for song in added:
+            index.add(song)
+
+        return index
+
+    def add(self, song):
+        """
+        Inserts a song's entries in place, e.g. when it's added to the catalog.
+        """
+
+        for entries, texts in zip((self.whole, self.words), get_prefixes(song)):
+            for text in texts:
+                bisect.insort(entries, (text, song.song))
+
+    def remove(self, song):
+        """
+        Deletes a song's entries in place, e.g. when it's removed from the catalog.
+        """
+
+        for entries, texts in zip((self.whole, self.words), get_prefixes(song)):
+            for text in texts:
+                i = bisect.bisect_left(entries, (text, song.song))
+
+                if i < len(entries) and entries[i] == (text, song.song):
+                    del entries[i]
+
+    def complete(self, prefix, limit = utils.COMPLETION_LIMIT):
+        """
+        :param prefix: What the user has typed so far
+        :param limit: Maximum number of completions
+        :return: List of song titles, whole string matches first and each
+                 group in alphabetical order
+        """
+
+        prefix = utils.normalize_query(prefix)
+        titles = []
+
+        if not prefix:
+            return titles
+
+        for entries in (self.whole, self.words):
+            i = bisect.bisect_left(entries, (prefix,))
+
+            while i < len(entries) and len(titles) < limit and entries[i][0].startswith(prefix):
+                if entries[i][1] not in titles:
+                    titles.append(entries[i][1])
+                i += 1
+
+        return titles
+
+#################################################
+
+def get_best_matches(matches):
+    """
+    Helper function. Returns every match tied for the best score.
+
+    :param matches: Ranked list of Match tuples
+    :return: List of Match tuples
+    """
+
+    if not matches:
+        return []
+
+    return [match for match in matches if match.score == matches[0].score]
+
+#################################################
+
+def parse_bpm(bpm):
+    """
+    BPMs are listed either as a single number or a range such as 140-180.
+    :param bpm: BPM as shown on the site
+    :return: Highest BPM of the song, 0 if there is none
+    """
+
+    numbers = re.findall(r"\d+(?:\.\d+)?", str(bpm))
+
+    return max(float(number) for number in numbers) if numbers else 0
+
+class LevelIndex:
+    """
+    Levels of every chart as an integer array, one column per difficulty in
+    the order of utils.LEVEL_COLUMNS (0 where a song has no such chart), so a
+    level query is a single mask over the whole catalog.
+    """
+    def __init__(self, songs):
+        self.songs = [song.song for song in songs]
+        self.levels = np.array([song.levels for song in songs], 
+                                dtype = np.int16).reshape(-1, len(utils.LEVEL_COLUMNS))
+        self.bpms = np.array([parse_bpm(song.bpm) for song in songs])
+
+    def search(self, low, high = None, difficulties = None, sort = None):
+        """
+        Finds every song with a chart within a range of levels.
+
+        :param low: Lowest level to look for
+        :param high: Highest level to look for, defaults to low
+        :param difficulties: Difficulties to consider, e.g. ['chaos'],
+                             defaults to all of them
+        :param sort: None to keep catalog order, 'level' to sort by the
+                     highest matching level, or 'bpm' to sort by BPM
+        :return: List of rows of matching songs
+        """
+
+        high = low if high is None else high
+        columns = [diff in (difficulties or utils.LEVEL_COLUMNS) 
+                        for diff in utils.LEVEL_COLUMNS]
+
+        mask = (self.levels >= low) & (self.levels <= high) & np.array(columns)
+        rows = np.flatnonzero(mask.any(axis = 1))
+
+        if sort == 'level':
+            levels = np.where(mask, self.levels, 0).max(axis = 1)[rows]
+            rows = rows[np.argsort(levels, kind = 'stable')]
+
+        elif sort == 'bpm':
+            rows = rows[np.argsort(self.bpms[rows], kind = 'stable')]
+
+        return rows.tolist()
+
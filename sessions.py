@@ -0,0 +1,30 @@
+import aiohttp
+import utils
+
+#################################################
+
+class SharedSession:
+    """
+    One aiohttp connection pool shared by everything the bot downloads while
+    serving commands (chart pages for artwork, screenshots for OCR), so 
+    connections are reused across them and there's a single session to
+    close when the bot shuts down.
+    """
+    def __init__(self, timeout = utils.HTTP_TIMEOUT, pool_size = utils.HTTP_POOL_SIZE):
+        self.timeout = aiohttp.ClientTimeout(total = timeout)
+        self.pool_size = pool_size
+        self.session = None
+
+    def get(self):
+        # created lazily since aiohttp sessions have to be made inside the loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                    timeout = self.timeout,
+                    connector = aiohttp.TCPConnector(limit = self.pool_size)
+                )
+
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,24 @@
+from aiohttp import web
+
+#################################################
+
+async def serve(handlers, function):
+    """
+    Runs function(base url) against a stand-in site on a free port.
+    :param handlers: Dictionary in the format {<path> : <aiohttp handler>}
+    :return: Whatever function returned
+    """
+
+    app = web.Application()
+    for path, handler in handlers.items():
+        app.router.add_get(path, handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+
+    try:
+        return await function(f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}")
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,113 @@
+from aiohttp import web
+from server import serve
+
+import asyncio
+import json
+import os
+
+import catalog
+
+#################################################
+
+with open(os.path.join(os.path.dirname(__file__), "chartlist.html"), "rb") as f:
+    CHARTLIST = f.read()
+
+# Ververg's chaos chart goes from 14 to 15, and Halcyon is taken down
+CHANGED = b"\n".join(line for line in CHARTLIST.replace(b"<td>14</td>", b"<td>15</td>").split(b"\n")
+                        if b"Halcyon" not in line)
+
+def site(state, hits):
+    """
+    Stand-in chart list that answers conditional requests the way the real
+    site does. Tests swap state['body'] and state['etag'] to change the page.
+    """
+
+    async def handler(request):
+        hits.append(dict(request.headers))
+
+        if state['etag'] and request.headers.get('If-None-Match') == state['etag']:
+            return web.Response(status = 304)
+
+        headers = {'ETag': state['etag']} if state['etag'] else {}
+        return web.Response(body = state['body'], headers = headers)
+
+    return {'/chartlist.html': handler}
+
+def run(state, hits, function):
+    """
+    Runs function(source url) in a thread, since the catalog fetches block.
+    """
+
+    async def call(base):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, base + "/chartlist.html")
+
+    return asyncio.run(serve(site(state, hits), call))
+
+#################################################
+
+def test_load_catalog_builds_and_saves_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "catalog.pickle")
+    state, hits = {'body': CHARTLIST, 'etag': '"v1"'}, []
+
+    data = run(state, hits, lambda source: catalog.load_catalog(path, source))
+
+    assert len(data) == 4
+    assert data.by_key["Koakuma"].title == "小悪魔の嘘"
+    assert data.etag == '"v1"'
+
+    saved = catalog.load_snapshot(path)
+    assert saved.version == data.version
+    assert saved.etag == data.etag
+    assert saved.songs == data.songs
+
+    # later starts use the snapshot without touching the site
+    assert run(state, hits, lambda source: catalog.load_catalog(path, source)).version == data.version
+    assert len(hits) == 1
+
+def test_revalidate_not_modified(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "catalog.pickle")
+    state, hits = {'body': CHARTLIST, 'etag': '"v1"'}, []
+
+    data = run(state, hits, lambda source: catalog.load_catalog(path, source))
+
+    assert run(state, hits, lambda source: catalog.revalidate(data, path, source)) is None
+    assert hits[-1].get('If-None-Match') == '"v1"'
+
+def test_revalidate_same_body(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "catalog.pickle")
+    state, hits = {'body': CHARTLIST, 'etag': None}, []
+
+    data = run(state, hits, lambda source: catalog.load_catalog(path, source))
+
+    assert run(state, hits, lambda source: catalog.revalidate(data, path, source)) is None
+    assert not os.path.exists(tmp_path / "changes.jsonl")
+
+def test_revalidate_changed_page(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "catalog.pickle")
+    state, hits = {'body': CHARTLIST, 'etag': '"v1"'}, []
+
+    data = run(state, hits, lambda source: catalog.load_catalog(path, source))
+
+    state['body'], state['etag'] = CHANGED, '"v2"'
+    updated = run(state, hits, lambda source: catalog.revalidate(data, path, source))
+
+    assert updated.version != data.version
+    assert updated.etag == '"v2"'
+    assert updated.changes == {
+        'added': [],
+        'removed': ["Halcyon"],
+        'changed': {'Ververg': {'levels': [(4, 9, 14, 0), (4, 9, 15, 0)]}},
+    }
+
+    # the new catalog replaced the snapshot, and the change was logged
+    assert catalog.load_snapshot(path).version == updated.version
+
+    with open(tmp_path / "changes.jsonl", encoding = "utf-8") as f:
+        entries = [json.loads(line) for line in f]
+
+    assert [entry['version'] for entry in entries] == [updated.version]
@@ -0,0 +1,127 @@
+from aiohttp import web
+from server import serve
+
+import asyncio
+
+import artwork
+import crawler
+
+#################################################
+
+PAGE = b'<html><body><p>Notes: 1024</p><img src="../../thumbnail/song.png"></body></html>'
+ARTWORK = artwork.parse_artwork(PAGE)
+
+def page(body = PAGE, status = 200, hits = None, path = None, **headers):
+    async def handler(request):
+        if hits is not None:
+            hits[path] = hits.get(path, 0) + 1
+        return web.Response(body = body, status = status, headers = headers)
+
+    return handler
+
+def make_crawler(tmp_path, **kwargs):
+    store = crawler.ChartStore(path = str(tmp_path / "charts.json"))
+    store.load()
+
+    # fast enough for tests, the backoff sleeps are what's being exercised
+    return crawler.ChartCrawler(store, rate = 1000, **kwargs)
+
+def crawl(tmp_path, handlers, charts, artwork_cache = None, **kwargs):
+    """
+    :param charts: Dictionary in the format {<key> : {<difficulty> : <path>}}
+    :return: Tuple of (crawl stats, ChartCrawler)
+    """
+
+    chart_crawler = make_crawler(tmp_path, **kwargs)
+
+    async def run(base):
+        merged_dict = {}
+        for key, paths in charts.items():
+            for diff, path in paths.items():
+                merged_dict.setdefault(f"{diff}.html", {})[key] = base + path
+
+        return await chart_crawler.crawl(merged_dict, artwork_cache)
+
+    return asyncio.run(serve(handlers, run)), chart_crawler
+
+#################################################
+
+def test_parse_chart():
+    assert crawler.parse_chart(PAGE) == (1024, ARTWORK)
+
+def test_retries_rate_limited_pages(tmp_path):
+    hits = {}
+    statuses = {'/a': [429, 200], '/b': [503, 503, 200]}
+
+    def flaky(path):
+        async def handler(request):
+            hits[path] = hits.get(path, 0) + 1
+            status = statuses[path].pop(0)
+            return web.Response(body = PAGE if status == 200 else b"", status = status,
+                                    headers = {} if status == 200 else {'Retry-After': "0"})
+        return handler
+
+    stats, chart_crawler = crawl(tmp_path, {'/a': flaky('/a'), '/b': flaky('/b')},
+                                    {'a': {'chaos': '/a'}, 'b': {'chaos': '/b'}})
+
+    assert stats == {'fetched': 2, 'skipped': 0, 'failed': 0}
+    assert hits == {'/a': 2, '/b': 3}
+    assert chart_crawler.store.get('b', 'chaos') == (1024, ARTWORK)
+
+def test_gives_up_after_retries(tmp_path):
+    hits = {}
+    stats, chart_crawler = crawl(tmp_path, {'/a': page(b"", 503, hits, '/a', **{'Retry-After': "0"})},
+                                    {'a': {'chaos': '/a'}}, retries = 2)
+
+    assert stats['failed'] == 1
+    assert hits['/a'] == 3
+    assert ('a', 'chaos') not in chart_crawler.store
+
+def test_missing_page_fails_without_retrying(tmp_path):
+    hits = {}
+    stats, chart_crawler = crawl(tmp_path, {'/a': page(hits = hits, path = '/a')},
+                                    {'a': {'chaos': '/a'}, 'b': {'chaos': '/missing'}})
+
+    assert stats == {'fetched': 1, 'skipped': 0, 'failed': 1}
+    assert chart_crawler.store.get('b', 'chaos') is None
+    assert chart_crawler.store.get('a', 'chaos') == (1024, ARTWORK)
+
+def test_unreadable_page_fails_alone(tmp_path):
+    stats, chart_crawler = crawl(tmp_path, {'/empty': page(b""), '/a': page()},
+                                    {'a': {'chaos': '/a'}, 'b': {'chaos': '/empty'}}, 
+                                    concurrency = 1)
+
+    assert stats == {'fetched': 1, 'skipped': 0, 'failed': 1}
+    assert chart_crawler.store.get('a', 'chaos') == (1024, ARTWORK)
+
+def test_resumes_from_saved_store(tmp_path):
+    store = crawler.ChartStore(path = str(tmp_path / "charts.json"))
+    store.put('a', 'chaos', (512, ARTWORK))
+    store.save()
+
+    hits = {}
+    charts = {'a': {'chaos': '/a'}, 'b': {'chaos': '/b', 'hard': '/b_hard'}}
+    handlers = {path: page(hits = hits, path = path) for path in ('/a', '/b', '/b_hard')}
+
+    stats, chart_crawler = crawl(tmp_path, handlers, charts)
+
+    assert stats == {'fetched': 2, 'skipped': 1, 'failed': 0}
+    assert '/a' not in hits
+    assert chart_crawler.store.get('a', 'chaos') == (512, ARTWORK)
+
+    # everything is stored now, so another crawl fetches nothing
+    stats, _ = crawl(tmp_path, handlers, charts)
+
+    assert stats == {'fetched': 0, 'skipped': 3, 'failed': 0}
+    assert hits == {'/b': 1, '/b_hard': 1}
+
+def test_fills_artwork_cache(tmp_path):
+    store = crawler.ChartStore(path = str(tmp_path / "charts.json"))
+    store.put('a', 'chaos', (512, "stored artwork"))
+    store.save()
+
+    artwork_cache = artwork.ArtworkCache(path = str(tmp_path / "artwork.json"))
+    crawl(tmp_path, {'/b': page(), '/b_hard': page()},
+            {'a': {'chaos': '/a'}, 'b': {'chaos': '/b', 'hard': '/b_hard'}}, artwork_cache)
+
+    assert dict(artwork_cache.entries) == {'a': "stored artwork", 'b': ARTWORK}
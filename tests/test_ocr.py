@@ -0,0 +1,71 @@
+import asyncio
+
+import cv2
+import numpy as np
+
+import cache
+import ocr
+import utils
+
+#################################################
+
+def make_screenshot(score):
+    """
+    A results screen on a fixed background, only the score differs.
+    :return: Bytes of a PNG file
+    """
+
+    rng = np.random.default_rng(0)
+    img = cv2.resize(rng.integers(0, 255, (9, 16), dtype = np.uint8), (1920, 1080),
+                        interpolation = cv2.INTER_LINEAR)
+
+    cv2.putText(img, "Chrome VOX", (500, 100), cv2.FONT_HERSHEY_SIMPLEX, 3, 255, 6)
+    cv2.putText(img, score, (150, 580), cv2.FONT_HERSHEY_SIMPLEX, 3, 255, 6)
+
+    return cv2.imencode('.png', img)[1].tobytes()
+
+class FakeEngine(ocr.OCREngine):
+    """
+    Reads the score the screenshot was made with instead of running
+    tesseract, counting how often the score is read.
+    """
+    def __init__(self, scores, **kwargs):
+        super().__init__(workers = 1, **kwargs)
+        self.scores = scores
+        self.reads = 0
+
+    async def submit(self, function, *args):
+        if function is ocr.read_title:
+            return "Chrome VOX"
+
+        self.reads += 1
+
+        return {'title': "Chrome VOX", 'score': self.scores[args[0]], 'tp': 99.5, 
+                'judgements': {}, 'title_crop': None, 'timings': {}}
+
+#################################################
+
+def test_similar_screenshots_hash_close():
+    # the premise: a different score barely changes the perceptual hash
+    first = ocr.perceptual_hash(make_screenshot("1000000"))
+    second = ocr.perceptual_hash(make_screenshot("0512345"))
+
+    assert (first ^ second).bit_count() <= utils.OCR_HASH_DISTANCE
+
+def test_different_score_is_read_again():
+    first, second = make_screenshot("1000000"), make_screenshot("0512345")
+    engine = FakeEngine({first: 1000000, second: 512345}, cache = cache.OCRCache())
+
+    async def run():
+        return [await engine.process(data) for data in (first, second, first)]
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        engine.shutdown()
+
+    assert [result['score'] for result in results] == [1000000, 512345, 1000000]
+    assert results[1]['title'] == "Chrome VOX"
+
+    # the same file again is answered from the cache
+    assert engine.reads == 2
@@ -0,0 +1,86 @@
+from fuzzywuzzy import fuzz
+
+import random
+import re
+
+import numpy as np
+
+import c2v
+import search
+import utils
+
+#################################################
+
+WORDS = ["chrome", "vox", "halcyon", "light", "night", "dream", "sky", "star"]
+KANA = ["さくら", "ゆめ", "ほし", "カーテン", "ソラ", "の"]
+KANJI = ["小", "悪", "魔", "嘘", "夜", "月", "花", "光"]
+
+def make_songs(titles):
+    return tuple(c2v.Song(title, "Artist", "120", "PAFF", f"song {i}")
+                    for i, title in enumerate(titles))
+
+def make_titles(rng, size):
+    titles = []
+
+    for i in range(size):
+        if rng.random() < 0.5:
+            title = "".join(rng.choice(KANJI + KANA) for _ in range(rng.randint(2, 5)))
+        else:
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+
+        titles.append(f"{title} {i}")
+
+    return titles
+
+def best_rows(index, query):
+    """
+    :return: Rows tied for the best score when every row is scored
+    """
+
+    normalized = search.normalize(query)
+    is_japanese = re.search(utils.JP_REGEX, query) is not None
+    scores = index.score(np.arange(len(index)), normalized, is_japanese)
+
+    if not len(scores) or scores.max() == 0:
+        return []
+
+    return np.flatnonzero(scores == scores.max()).tolist()
+
+#################################################
+
+def test_japanese_substring_is_found():
+    songs = make_songs(["小悪魔の嘘", "Chrome VOX", "夜の月"])
+    index = search.SearchIndex(songs)
+
+    matches = index.search("悪魔")
+
+    assert matches[0] == search.Match(0, fuzz.token_set_ratio("小悪魔の嘘", "悪魔"))
+
+def test_bounds_never_below_scores():
+    rng = random.Random(0)
+    index = search.SearchIndex(make_songs(make_titles(rng, 100)))
+
+    for query in ["悪魔", "夜", "ソラ", "chr", "night sky", "月の花"]:
+        normalized = search.normalize(query)
+        is_japanese = re.search(utils.JP_REGEX, query) is not None
+
+        # bounds only hold for rows sharing no token, i.e. not candidates
+        rows = np.setdiff1d(np.arange(len(index)), index.get_candidates(normalized))
+
+        assert (index.get_bounds(normalized, is_japanese)[rows] >= 
+                    index.score(rows, normalized, is_japanese)).all(), query
+
+def test_best_matches_same_as_scoring_every_row():
+    rng = random.Random(1)
+    index = search.SearchIndex(make_songs(make_titles(rng, 200)))
+    characters = KANJI + KANA + list("aceghilnorstvy")
+
+    for _ in range(300):
+        query = "".join(rng.choice(characters) for _ in range(rng.randint(1, 4)))
+
+        if index.lookup(query) is not None:
+            continue
+
+        got = sorted(match.row for match in search.get_best_matches(index.search(query)))
+
+        assert got == best_rows(index, query), query
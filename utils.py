@@ -1,9 +1,45 @@
+import os
 import re
-import discord
+import unicodedata
 
 SOURCE = "https://ct2view.the-kitti.com/chartlist.html"
 PREFIX = "https://ct2view.the-kitti.com"
 
+# local copy of the preprocessed catalog, loaded at startup instead of scraping
+SNAPSHOT_PATH = "catalog.pkl"
+
+# title -> romanization cache, so pykakasi only runs for new titles
+ROMANIZATION_PATH = "romanizations.json"
+
+# every catalog update's added, removed and changed songs, as JSON lines
+CHANGELOG_PATH = "changes.jsonl"
+
+# alias -> song title or key, for abbreviations and nicknames people search by
+ALIAS_PATH = "aliases.json"
+
+# song key -> artwork link cache, persisted across restarts
+ARTWORK_PATH = "artwork.json"
+ARTWORK_CACHE_SIZE = 2048
+
+# seconds between saves of the persisted caches (artwork, OCR results),
+# which are only written out if they changed
+CACHE_SAVE_INTERVAL = 60
+
+# outbound requests to the site: seconds per request, pooled connections,
+# and chart pages fetched at once when prefetching artwork
+HTTP_TIMEOUT = 10
+HTTP_POOL_SIZE = 8
+PREFETCH_CONCURRENCY = 4
+
+# bulk crawl of every chart page: pages fetched at once, most requests
+# started per second, retries per page, and pages crawled between saves
+# of the chart store so an interrupted crawl resumes close to where it was
+CHART_STORE_PATH = "charts.json"
+CRAWL_CONCURRENCY = 4
+CRAWL_RATE = 2
+CRAWL_RETRIES = 3
+CRAWL_SAVE_EVERY = 50
+
 # regex to detect Japanese characters + Kanji
 # for the purpose of this program it doesn't really matter to distinguish mandarin/kanji input
 JP_REGEX = re.compile('[\u4E00-\u9FAF]|[\u3000-\u303F]|[\u3040-\u309F]|\
@@ -24,12 +60,119 @@ REGEXES_BY_DIFF = {
     "glitch.html": re.compile("chartlist\/(.*?)\/glitch")
 }
 
+# site table headers (as numbered by pd.read_html) to DataFrame column names
+COLUMN_NAMES = {
+    "Lv.": "Diff_E", "Lv..1": "Diff_H", "Lv..2": "Diff_C", "Lv..3": "Diff_G",
+    "Chart Page": "Chart_E", "Chart Page.1": "Chart_H", "Chart Page.2": "Chart_C",
+    "Chart Page.3": "Chart_G", "Chart Page.4": "Chart_CR"
+}
+
+# difficulty names used by !c2d -> DataFrame column holding that chart's level
+LEVEL_COLUMNS = {
+    "easy": "Diff_E", "hard": "Diff_H", "chaos": "Diff_C", "glitch": "Diff_G"
+}
+
+# range of levels !c2d accepts
+MIN_LEVEL, MAX_LEVEL = 1, 15
+
+# seconds between catalog refreshes, and before the first retry of a failed
+# one (doubling with each failure, up to the normal interval)
+REFRESH_INTERVAL = 6 * 60 * 60
+REFRESH_RETRY = 60
+
+# a refreshed catalog with fewer songs than this fraction of the current
+# one is assumed to come from a broken page and is rejected
+MIN_CATALOG_RATIO = 0.5
+
+# worker processes searches run in, how many searches each command may run
+# at once, and how many may be waiting before new ones are turned away
+SEARCH_WORKERS = 2
+SEARCH_LIMITS = {"c2s": 8, "c2d": 4, "c2m": 4}
+SEARCH_MAX_PENDING = 32
+
+# tesseract binary (on PATH by default on Linux), worker processes running
+# OCR, jobs allowed to wait, and seconds before a job is abandoned
+TESSERACT_CMD = os.environ.get("TESSERACT_CMD", "tesseract")
+OCR_WORKERS = 2
+OCR_MAX_PENDING = 16
+OCR_TIMEOUT = 20
+
+# grayscale level (after raising contrast) above which a pixel counts as
+# text when binarizing the digit regions
+OCR_THRESHOLD = 128
+
+# largest screenshot accepted, and the height (shorter side) screenshots
+# are shrunk to before OCR
+SCREENSHOT_MAX_BYTES = 8 * 1024 * 1024
+OCR_MAX_HEIGHT = 1080
+
+# match score a title read from a screenshot needs to be taken as that song,
+# and to skip the slower multilingual pass over the title
+TITLE_MIN_SCORE = 50
+TITLE_MATCH_SCORE = 85
+
+# number of screenshot OCR results kept, where they are persisted (None to
+# keep them in memory only), and how many of the 64 bits of two perceptual
+# hashes may differ for the screenshots to count as showing the same song
+OCR_CACHE_SIZE = 1024
+OCR_CACHE_PATH = "ocr_cache.json"
+OCR_HASH_DISTANCE = 4
+
+# timing of each stage of the bot, METRICS=0 turns it off. Also written
+# every METRICS_INTERVAL seconds in the Prometheus text format to METRICS_PATH
+METRICS_ENABLED = os.environ.get("METRICS", "1") != "0"
+METRICS_PATH = "metrics.prom"
+METRICS_INTERVAL = 60
+
+# PROFILE_STARTUP=1 prints how long each import and startup step took.
+# Dependencies that should only be imported once a command needs them are
+# listed as loaded or not, so one being imported eagerly again stands out
+PROFILE_STARTUP = os.environ.get("PROFILE_STARTUP") == "1"
+LAZY_MODULES = ["pandas", "lxml", "pykakasi", "requests", "cv2", "pytesseract"]
+
+# number of finished !c2s results kept in memory
+QUERY_CACHE_SIZE = 512
+
+# !c2d results: most characters on a page (an embed description holds up
+# to 4096), reactions that turn pages, and how many paged messages can be
+# turned, for how many seconds
+PAGE_CHARS = 4096
+PAGE_REACTIONS = {"\u25c0\ufe0f": -1, "\u25b6\ufe0f": 1}
+PAGE_CACHE_SIZE = 256
+PAGE_TTL = 15 * 60
+
+# most messages (or edits) sent to a channel per SEND_PERIOD seconds,
+# Discord allows about 5 per 5 seconds
+SEND_RATE = 5
+SEND_PERIOD = 5
+
+# !c2m: most songs searched at once, and characters of each query shown
+# in the result table before it is cut short
+BATCH_QUERY_LIMIT = 20
+BATCH_QUERY_CHARS = 32
+
+# most completions offered for a partial title, Discord's limit on choices
+COMPLETION_LIMIT = 25
+
 #################################################
 
+def normalize_query(query):
+    """
+    Reduces a search query to a canonical form, so queries that only differ
+    in case, width, spacing or stray emotes/pings share a cache entry.
+    """
+    query = unicodedata.normalize('NFKC', query)
+    query = EMOTE_REGEX.sub(" ", query)
+    query = PING_REGEX.sub(" ", query)
+
+    return " ".join(query.casefold().split())
+
 def generate_embed(status, msg):
     """
     Returns a Discord Embed with color depending on the message's status and custom error message.
     """
+    import discord
+
     colors = {
         'Error': 0x992d22
     }